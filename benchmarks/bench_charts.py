@@ -0,0 +1,81 @@
+"""Measures the cost of the GUI charts: incremental scrolling vs redrawing the whole history.
+
+Reports the time per chart update and the CPU share at the 2 Hz chart rate, for the chart thread
+and (when a display is available) for the PhotoImage swap done by the Tk thread.
+
+Usage: python benchmarks/bench_charts.py [updates] [clients]
+"""
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+
+from server_charts import (ChartRenderer, CHART_WIDTH, CHART_HEIGHT, CHART_STEP, CHART_INTERVAL, CHART_BACKGROUND,
+                           CPU_COLOR, MEM_COLOR)
+
+def wave(index, period, offset=0.0):
+    """Returns a test value between 0 and 100"""
+    return 50 + 45 * math.sin(index / period + offset)
+
+def redraw_all(history):
+    """The naive way: a new image with every point of the history"""
+    image = Image.new('RGB', (CHART_WIDTH, CHART_HEIGHT), CHART_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    for column, color in ((0, CPU_COLOR), (1, MEM_COLOR)):
+        points = [(CHART_WIDTH - 1 - (len(history) - 1 - index) * CHART_STEP,
+                   CHART_HEIGHT - 1 - int(values[column] / 100 * (CHART_HEIGHT - 1)))
+                  for index, values in enumerate(history)]
+        draw.line(points, fill=color)
+    return image
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    counter = [0]
+    renderer = ChartRenderer(lambda: (wave(counter[0], 7), wave(counter[0], 31, 1.0)),
+                             lambda: {('10.0.0.1', port): wave(counter[0], 5, port) / 2000 for port in range(clients)})
+    start = time.perf_counter()
+    for counter[0] in range(updates):
+        renderer.render()
+    incremental = (time.perf_counter() - start) / updates
+
+    history = []
+    points = CHART_WIDTH // CHART_STEP + 1
+    start = time.perf_counter()
+    for index in range(updates):
+        history.append((wave(index, 7), wave(index, 31, 1.0)))
+        del history[:-points]
+        redraw_all(history)
+    full = (time.perf_counter() - start) / updates
+
+    rate = 1 / CHART_INTERVAL
+    print(f"{'chart update':<34} {'ms/update':>10} {'CPU at 2 Hz':>12}")
+    print(f"{'incremental (system + latency)':<34} {incremental * 1000:>10.3f} {incremental * rate * 100:>11.2f}%")
+    print(f"{'full redraw (system only)':<34} {full * 1000:>10.3f} {full * rate * 100:>11.2f}%")
+
+    try:
+        import tkinter as tk
+        from PIL import ImageTk
+        root = tk.Tk()
+    except Exception as e:
+        print(f"PhotoImage swap not measured (no display: {e})")
+        return
+    try:
+        system, latency = renderer.take() or (renderer.system.image, renderer.latency.image)
+        photos = (ImageTk.PhotoImage(system), ImageTk.PhotoImage(latency))
+        start = time.perf_counter()
+        for _ in range(updates):
+            photos[0].paste(system)
+            photos[1].paste(latency)
+        swap = (time.perf_counter() - start) / updates
+        print(f"{'PhotoImage swap (Tk thread)':<34} {swap * 1000:>10.3f} {swap * rate * 100:>11.2f}%")
+    finally:
+        root.destroy()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Compares the per-frame cost of struct.pack + sendall with the preallocated FrameWriter.
+
+For each writer it reports the time per frame, the peak traced memory of one frame (tracemalloc)
+and the send() calls per frame. A second pass shrinks the socket buffers and reads slowly,
+so partial sends happen, and checks that every frame arrives intact.
+
+Usage: python benchmarks/bench_frames.py [frames]
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from keyboard_server import FRAME, FrameWriter, SystemSnapshot
+
+# Socket wrapper counting the send() calls (sendall is counted once, it loops in C)
+class CountingSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.calls += 1
+        return self.sock.sendall(data)
+
+def pack_and_sendall(sock, snapshot, writer):
+    """The previous way: a new bytes object per frame"""
+    sock.sendall(struct.pack('<ff', snapshot.cpu / 100.0, snapshot.mem / 100.0))
+
+def frame_writer(sock, snapshot, writer):
+    """Packs into the preallocated buffer and resumes partial sends"""
+    writer.pack(snapshot)
+    while not writer.write(sock):
+        pass
+
+def drain(sock, frames, received, delay=0.0):
+    """Reads frames * FRAME.size bytes, optionally slowly, into received"""
+    remaining = frames * FRAME.size
+    while remaining:
+        data = sock.recv(min(remaining, 4096))
+        if not data:
+            break
+        received.extend(data)
+        remaining -= len(data)
+        if delay:
+            time.sleep(delay)
+
+def measure(send, frames):
+    """Returns the time per frame in microseconds, the peak traced bytes of one frame and the send() calls per frame"""
+    left, right = socket.socketpair()
+    snapshot = SystemSnapshot(42.0, 63.5, None, 0.0)
+    writer = FrameWriter()
+    sock = CountingSocket(left)
+    received = bytearray()
+    reader = threading.Thread(target=drain, args=(right, frames * 2 + 2, received))
+    reader.start()
+    try:
+        # Warm up (and build the objects cached by the first call)
+        send(sock, snapshot, writer)
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            send(sock, snapshot, writer)
+        elapsed = time.perf_counter() - start
+
+        # The objects of a frame are freed right away, so look at the peak of a single frame
+        tracemalloc.start()
+        send(sock, snapshot, writer)
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        send(sock, snapshot, writer)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        sock.calls = 0
+        for _ in range(frames):
+            send(sock, snapshot, writer)
+        sends = sock.calls
+    finally:
+        reader.join()
+        left.close()
+        right.close()
+    return elapsed / frames * 1e6, peak - baseline, sends / frames
+
+def check_partial_sends(frames):
+    """Sends frames through tiny, slowly drained socket buffers and returns (send calls, frames intact)"""
+    left, right = socket.socketpair()
+    left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024)
+    right.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+    left.setblocking(False)
+    writer = FrameWriter()
+    sock = CountingSocket(left)
+    received = bytearray()
+    reader = threading.Thread(target=drain, args=(right, frames, received, 0.0005))
+    reader.start()
+    try:
+        for index in range(frames):
+            writer.pack(SystemSnapshot(index % 101, 100 - index % 101, None, 0.0))
+            while True:
+                try:
+                    if writer.write(sock):
+                        break
+                except BlockingIOError:
+                    time.sleep(0.0001)
+    finally:
+        reader.join()
+        left.close()
+        right.close()
+
+    intact = 0
+    for index, (cpu, mem) in enumerate(FRAME.iter_unpack(bytes(received))):
+        if abs(cpu - index % 101 / 100.0) < 1e-6 and abs(mem - (100 - index % 101) / 100.0) < 1e-6:
+            intact += 1
+    return sock.calls, intact
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"{'writer':<18} {'us/frame':>9} {'peak bytes':>11} {'sends/frame':>12}")
+    for name, send in (('pack + sendall', pack_and_sendall), ('FrameWriter', frame_writer)):
+        per_frame, peak, sends = measure(send, frames)
+        print(f"{name:<18} {per_frame:>9.2f} {peak:>11} {sends:>12.2f}")
+
+    partial_frames = min(frames, 5000)
+    calls, intact = check_partial_sends(partial_frames)
+    print(f"partial sends: {partial_frames} frames, {calls} send() calls "
+          f"({calls - partial_frames} resumed or retried), {intact}/{partial_frames} intact")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Measures the cost of a log call on the calling thread (the sampling or serving thread):
+the server log methods with debug off, and a queued record with the stock QueueHandler (formatted by the caller)
+vs the DeferredQueueHandler of the server (formatted by the listener thread).
+
+Usage: python benchmarks/bench_logging.py [iterations]
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from keyboard_server import KeyboardDataServer, DeferredQueueHandler
+
+ADDRESS = ('192.168.1.20', 52144)
+MESSAGE = "Data sent to: %s: CPU: %s%%, Memory: %s%%"
+
+def measure(call, iterations):
+    """Returns the time per call in microseconds"""
+    call()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def queued_logger(handler_class):
+    """Returns a logger queuing its records through handler_class, without a listener (only the caller is timed)"""
+    logger = logging.Logger('bench', logging.DEBUG)
+    logger.addHandler(handler_class(queue.SimpleQueue()))
+    return logger
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    server = KeyboardDataServer(port=0, debug=False)
+    try:
+        results = [
+            ('log(), debug off', measure(lambda: server.log(MESSAGE, ADDRESS, 12.5, 40.0), iterations)),
+            ('log_throttled(), debug off',
+             measure(lambda: server.log_throttled(ADDRESS, 'sent', MESSAGE, ADDRESS, 12.5, 40.0), iterations)),
+        ]
+    finally:
+        server.close()
+
+    for handler_class in (logging.handlers.QueueHandler, DeferredQueueHandler):
+        logger = queued_logger(handler_class)
+        results.append((f'{handler_class.__name__}, debug on',
+                        measure(lambda: logger.debug(MESSAGE, ADDRESS, 12.5, 40.0), iterations)))
+
+    print(f"{'call':<34} {'us/call':>8}")
+    for name, cost in results:
+        print(f"{name:<34} {cost:>8.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Compares the cost of a sample with the psutil providers and the cached /proc readers,
+and measures the process table scan of the top-process providers (first scan vs cached pid map).
+
+Usage: python benchmarks/bench_providers.py [iterations]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psutil
+
+from metrics_providers import PROVIDERS, ProcessScanner, has_proc
+
+PAIRS = [('psutil-cpu', 'proc-cpu'), ('psutil-mem', 'proc-mem')]
+
+def measure(provider, iterations):
+    """Returns the time per read in microseconds and the peak traced memory of one read in bytes"""
+    provider.read()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        provider.read()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    provider.read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / iterations * 1e6, peak
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    if not has_proc():
+        print("The /proc providers need Linux, only the psutil path is measured")
+
+    print(f"{'provider':<12} {'us/read':>10} {'peak bytes':>12}")
+    for names in PAIRS:
+        for name in names:
+            if name.startswith('proc-') and not has_proc():
+                continue
+            provider = PROVIDERS[name]()
+            try:
+                per_read, peak = measure(provider, iterations)
+            finally:
+                provider.close()
+            print(f"{name:<12} {per_read:>10.2f} {peak:>12}")
+
+    # The scan runs in the background, a frame only pays for the read of its result
+    scanner = ProcessScanner()
+    start = time.perf_counter()
+    scanner.scan()
+    first = time.perf_counter() - start
+    scans = 20
+    start = time.perf_counter()
+    for _ in range(scans):
+        scanner.scan()
+    cached = (time.perf_counter() - start) / scans
+    start = time.perf_counter()
+    for process in psutil.process_iter(['name', 'cpu_percent', 'memory_info']):
+        pass
+    fresh = time.perf_counter() - start
+    print(f"\nprocess scan of {len(scanner.processes)} processes (every {scanner.interval}s, in its own thread)")
+    print(f"{'first scan':<28} {first * 1000:>8.2f} ms")
+    print(f"{'cached pid map':<28} {cached * 1000:>8.2f} ms")
+    print(f"{'process_iter, all attributes':<28} {fresh * 1000:>8.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measures the aggregation cost of a relay: incremental NodeAggregator vs recomputing over every node.
+
+Each round updates one random node and reads the max, min and average of both columns,
+as the relay does for every upstream frame and every sample.
+
+Usage: python benchmarks/bench_relay.py [nodes,...] [updates]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from relay import NodeAggregator, COLUMNS, AGGREGATES
+
+def recompute(values, index, aggregate):
+    """The naive way: a pass over every node"""
+    column = [node_values[index] for node_values in values.values()]
+    if aggregate == 'avg':
+        return sum(column) / len(column)
+    return max(column) if aggregate == 'max' else min(column)
+
+def main():
+    node_counts = [int(count) for count in sys.argv[1].split(',')] if len(sys.argv) > 1 else [10, 100, 500, 2000]
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    print(f"{'nodes':>6} {'incremental µs':>15} {'recompute µs':>13}")
+    for count in node_counts:
+        rounds = [(random.randrange(count), (random.uniform(0, 100), random.uniform(0, 100))) for _ in range(updates)]
+        aggregator = NodeAggregator()
+        values = {}
+        for node in range(count):
+            aggregator.update(node, (50.0, 50.0))
+            values[node] = (50.0, 50.0)
+
+        start = time.perf_counter()
+        for node, node_values in rounds:
+            aggregator.update(node, node_values)
+            for column in COLUMNS:
+                for aggregate in AGGREGATES:
+                    aggregator.value(column, aggregate)
+        incremental = (time.perf_counter() - start) / updates
+
+        start = time.perf_counter()
+        for node, node_values in rounds:
+            values[node] = node_values
+            for index in range(len(COLUMNS)):
+                for aggregate in AGGREGATES:
+                    recompute(values, index, aggregate)
+        full = (time.perf_counter() - start) / updates
+
+        # Both must agree
+        for index, column in enumerate(COLUMNS):
+            for aggregate in AGGREGATES:
+                assert abs(aggregator.value(column, aggregate) - recompute(values, index, aggregate)) < 1e-6
+        print(f"{count:>6} {incremental * 1e6:>15.2f} {full * 1e6:>13.2f}")
+
+if __name__ == "__main__":
+    main()
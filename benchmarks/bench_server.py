@@ -0,0 +1,123 @@
+"""Runs the headless server against fleets of simulated keyboards and reports its throughput and cost.
+
+For each engine and client count it reports frames/sec, ACK->frame latency percentiles,
+server CPU time, thread count and RSS.
+
+With --workers N the server runs sharded across N worker processes (Linux), and the CPU time, threads and
+RSS are those of the whole process tree.
+
+Usage: python benchmarks/bench_server.py [--engines threads,asyncio,broadcast] [--clients 1,10,50,100,500] [--duration 10]
+       [--workers N]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import psutil
+
+from fake_keyboard import run_fleet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The whole fleet connects from 127.0.0.1: without lifting the connection limits (64 clients, 8 per IP by default)
+# the server would refuse most of it
+NO_LIMITS = ["--max-clients", "0", "--max-clients-per-ip", "0"]
+
+def start_server(engine, port, workers=0):
+    """Starts the headless server in a subprocess and waits until it accepts connections"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "keyboard_server.py"), "serve", "--engine", engine, "--port", str(port),
+         "--workers", str(workers), *NO_LIMITS],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            # A quick connect/close tells that the server is listening
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The server did not start")
+
+def stop_server(process):
+    """Stops the server like an operator would (SIGINT), killing it if it does not exit"""
+    process.send_signal(signal.SIGINT if sys.platform != 'win32' else signal.CTRL_C_EVENT)
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def process_tree(pid):
+    """Returns the server process and its workers"""
+    server = psutil.Process(pid)
+    return [server, *server.children(recursive=True)]
+
+def tree_cpu_seconds(processes):
+    """Returns the CPU time used by processes, 0 for those that already exited"""
+    total = 0.0
+    for process in processes:
+        try:
+            times = process.cpu_times()
+        except psutil.Error:
+            continue
+        total += times.user + times.system
+    return total
+
+def bench(engine, clients, duration, port, workers=0):
+    """Runs one fleet against a fresh server and returns a result row"""
+    process = start_server(engine, port, workers)
+    try:
+        if workers:
+            # The port answers as soon as the first worker listens, give the others time to start
+            time.sleep(2)
+        processes = process_tree(process.pid)
+        cpu_before = tree_cpu_seconds(processes)
+        stats = asyncio.run(run_fleet("127.0.0.1", port, clients, duration))
+        cpu_after = tree_cpu_seconds(processes)
+        threads = sum(server.num_threads() for server in processes)
+        rss_mb = sum(server.memory_info().rss for server in processes) / (1024 * 1024)
+    finally:
+        stop_server(process)
+
+    cpu_seconds = cpu_after - cpu_before
+    return {
+        'engine': engine,
+        'clients': clients,
+        'connected': stats.connected,
+        'fps': stats.frames / duration,
+        'p50': stats.percentile(50),
+        'p95': stats.percentile(95),
+        'p99': stats.percentile(99),
+        'cpu': cpu_seconds,
+        'threads': threads,
+        'rss': rss_mb,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the keyboard data server")
+    parser.add_argument("--engines", default="threads,asyncio,broadcast")
+    parser.add_argument("--clients", default="1,10,50,100,500")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=16480)
+    parser.add_argument("--workers", type=int, default=0, help="Run the server sharded across N processes (Linux)")
+    args = parser.parse_args()
+
+    print(f"{'engine':<10} {'clients':>7} {'conn':>5} {'frames/s':>9} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+          f"{'cpu s':>6} {'threads':>7} {'rss MB':>7}")
+    for engine in args.engines.split(','):
+        for clients in (int(count) for count in args.clients.split(',')):
+            row = bench(engine, clients, args.duration, args.port, args.workers)
+            print(f"{row['engine']:<10} {row['clients']:>7} {row['connected']:>5} {row['fps']:>9.1f} "
+                  f"{row['p50']:>7.1f} {row['p95']:>7.1f} {row['p99']:>7.1f} "
+                  f"{row['cpu']:>6.2f} {row['threads']:>7} {row['rss']:>7.1f}")
+
+if __name__ == "__main__":
+    main()
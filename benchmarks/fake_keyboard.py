@@ -0,0 +1,120 @@
+"""Simulated Skyloong keyboards speaking the server protocol: read an 8-byte '<ff' frame, answer a 1-byte ACK.
+
+A single asyncio loop drives all the keyboards, so hundreds of them can run on localhost.
+With --ack-replay the ACKs are delayed by the latencies of a recording (serve --record), in order and looping,
+so the timing of real keyboards is reproduced.
+Every keyboard connects from 127.0.0.1: start the server with --max-clients 0 --max-clients-per-ip 0 to run more
+than 8 of them.
+
+Usage: python benchmarks/fake_keyboard.py [--host 127.0.0.1] [--port 1648] [--clients 100] [--duration 10]
+                                          [--ack-delay 0 | --ack-replay FILE]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import struct
+import sys
+import time
+
+FRAME = struct.Struct('<ff')
+ACK = b'\x01'
+
+# Results shared by the keyboards of one fleet
+class FleetStats:
+    def __init__(self):
+        self.frames = 0
+        self.connected = 0
+        self.disconnected = 0
+        self.errors = 0
+        self.invalid_frames = 0
+        # Time from an ACK to the next frame, in seconds: how quickly the server answers
+        self.latencies = []
+
+    def percentile(self, percent):
+        """Returns the latency percentile in milliseconds"""
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+        return latencies[index] * 1000
+
+async def fake_keyboard(host, port, deadline, stats, ack_delay=0.0, ack_delays=None):
+    """Runs one keyboard until the deadline (ack_delays: iterator of ACK delays shared by the fleet)"""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats.errors += 1
+        return
+    stats.connected += 1
+    last_ack = None
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                data = await asyncio.wait_for(reader.readexactly(FRAME.size), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            received = time.monotonic()
+            stats.frames += 1
+            if last_ack is not None:
+                stats.latencies.append(received - last_ack)
+
+            cpu, mem = FRAME.unpack(data)
+            if not (0.0 <= cpu <= 1.0 and 0.0 <= mem <= 1.0):
+                stats.invalid_frames += 1
+
+            # A slow keyboard can be simulated by delaying the ACK
+            delay = next(ack_delays) if ack_delays is not None else ack_delay
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(ACK)
+            await writer.drain()
+            last_ack = time.monotonic()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        stats.disconnected += 1
+    finally:
+        writer.close()
+
+async def run_fleet(host, port, clients, duration, ack_delay=0.0, connect_batch=50, ack_delays=None):
+    """Connects the keyboards (in batches, to stay below the listen backlog) and runs them for duration seconds"""
+    stats = FleetStats()
+    deadline = time.monotonic() + duration
+    tasks = []
+    for index in range(clients):
+        tasks.append(asyncio.ensure_future(fake_keyboard(host, port, deadline, stats, ack_delay, ack_delays)))
+        if (index + 1) % connect_batch == 0:
+            await asyncio.sleep(0.05)
+    await asyncio.gather(*tasks)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Skyloong keyboards")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1648)
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--ack-delay", type=float, default=0.0, help="Seconds to wait before each ACK")
+    parser.add_argument("--ack-replay", metavar="FILE", help="Delay the ACKs by the latencies of a recording")
+    args = parser.parse_args()
+
+    ack_delays = None
+    if args.ack_replay:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from recording import Recording
+        latencies = list(Recording(args.ack_replay).ack_latencies())
+        if not latencies:
+            parser.error(f"{args.ack_replay} contains no ACK")
+        ack_delays = itertools.cycle(latencies)
+
+    stats = asyncio.run(run_fleet(args.host, args.port, args.clients, args.duration, args.ack_delay,
+                                  ack_delays=ack_delays))
+    print(f"connected {stats.connected}/{args.clients}, errors {stats.errors}, disconnected {stats.disconnected}")
+    print(f"frames {stats.frames} ({stats.frames / args.duration:.1f}/s), invalid {stats.invalid_frames}")
+    print(f"ACK->frame latency ms: p50 {stats.percentile(50):.1f}  p95 {stats.percentile(95):.1f}  "
+          f"p99 {stats.percentile(99):.1f}")
+
+if __name__ == "__main__":
+    main()
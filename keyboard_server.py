@@ -0,0 +1,1667 @@
+# Pure server module: only the networking and sampling dependencies are imported here,
+# so the headless entry point never loads tkinter, Pillow or pystray.
+from startup_profile import STARTUP
+import socket
+import selectors
+import time
+import threading
+import queue
+import logging
+import logging.handlers
+import psutil
+import signal
+import sys
+import itertools
+from collections import namedtuple
+STARTUP.mark('standard library and psutil imported')
+from listeners import (UNIX_PREFIX, IPV4_MAPPED_PREFIX, create_listen_sockets, close_listen_sockets,
+                       describe_socket, is_unix_socket, unix_socket_paths)
+from metrics_providers import create_providers
+from power import WHEEL, LOCKED_FRAME_INTERVAL, ScreenLockMonitor, aligned_delay
+from protocol_profiles import (PROFILES, DEFAULT_PROFILE, HELLO_MAX_SIZE, load_profiles, parse_client_profiles,
+                               parse_hello)
+from server_config import SETTINGS, LIVE_SETTINGS, ConfigWatcher, load_config
+from server_metrics import ServerMetrics, MetricsHTTPServer
+STARTUP.mark('server modules imported')
+
+# Data frame of the default profile (GK104 Pro): CPU and memory as fractions (0-1), little-endian floats
+FRAME = PROFILES[DEFAULT_PROFILE].frame
+
+# Immutable snapshot of the last system sample, shared by every reader
+# packet is the pre-packed 8-byte '<ff' payload sent to the keyboards, label the text of the providers
+# (e.g. the name of the top process) for the profiles with a 'label' field
+SystemSnapshot = namedtuple('SystemSnapshot', ['cpu', 'mem', 'packet', 'timestamp', 'label'], defaults=(None,))
+
+# Sampler class for the system metrics
+# A single timer of the shared timer wheel samples CPU and memory at a fixed rate and publishes a snapshot,
+# so the sampling cost does not depend on the number of connected keyboards. While the server is idle
+# (no keyboard or screen locked) it samples at the idle period of the wheel.
+class MetricsSampler:
+    def __init__(self, interval=0.5, providers=None, fast_interval=None, spike_threshold=10.0, history=None,
+                 smoothing=None):
+        self.interval = interval
+        # Optional faster rate used after a value jumped by spike_threshold points (adaptive mode)
+        self.fast_interval = fast_interval
+        self.spike_threshold = spike_threshold
+        # Optional ServerMetrics receiving the sampling durations
+        self.metrics = None
+        # Called with every new snapshot by the sampling thread (e.g. to publish it to the worker processes)
+        self.on_sample = None
+        # Optional MetricsHistory recording every sample; with smoothing (seconds), the snapshot carries
+        # the average of that window instead of the raw values, so the keyboards show steadier values
+        self.history = history
+        self.smoothing = smoothing
+        self.running = False
+        self.timer = None
+        # The two values of the packet (CPU and memory by default, see metrics_providers)
+        self.providers = providers if providers is not None else create_providers('cpu,mem')
+        # Providers replacing the current ones at the next sample (configuration reload)
+        self.pending_providers = None
+        self.snapshot = self.sample()
+
+    def sample(self):
+        """Reads the two metrics and builds a new snapshot"""
+        # Swapped here, by the sampling thread, so a provider is never closed in the middle of a read
+        pending = self.pending_providers
+        if pending is not None:
+            self.pending_providers = None
+            previous, self.providers = self.providers, pending
+            for provider in previous:
+                provider.close()
+        # Non-blocking: the CPU usage is measured since the previous call
+        cpu = self.providers[0].read()
+        mem = self.providers[1].read()
+        timestamp = time.time()
+        if self.history is not None:
+            self.history.add(timestamp, cpu, mem)
+            if self.smoothing:
+                cpu, mem = self.history.smoothed(self.smoothing, timestamp)
+        packet = FRAME.pack(cpu / 100.0, mem / 100.0)
+        return SystemSnapshot(cpu, mem, packet, timestamp, self.providers[0].label or self.providers[1].label)
+
+    def start(self):
+        """Starts sampling on the timer wheel (does nothing if already running)"""
+        if self.running:
+            return False
+        self.running = True
+        self.timer = WHEEL.schedule(self.tick, self.interval, name='sampler')
+        return True
+
+    def tick(self):
+        """Takes one sample (timer callback), returns the faster period after a spike in adaptive mode"""
+        try:
+            previous = self.snapshot
+            started = time.perf_counter()
+            # Replacing the reference is atomic, readers never see a half-built snapshot
+            self.snapshot = self.sample()
+            if self.metrics is not None:
+                self.metrics.observe('sampling_duration_seconds', time.perf_counter() - started)
+            if self.on_sample is not None:
+                self.on_sample(self.snapshot)
+            # Sample faster while the load is moving quickly
+            if self.fast_interval is not None and (
+                    abs(self.snapshot.cpu - previous.cpu) >= self.spike_threshold or
+                    abs(self.snapshot.mem - previous.mem) >= self.spike_threshold):
+                return self.fast_interval
+        except Exception as e:
+            print(f"Error while sampling the system: {e}")
+        return None
+
+    def set_interval(self, interval):
+        """Changes the sampling period, applied right away"""
+        self.interval = interval
+        if self.timer is not None:
+            WHEEL.reschedule(self.timer, interval)
+
+    def replace_providers(self, providers):
+        """Switches to new providers from the next sample, the current ones are then closed"""
+        self.pending_providers = providers
+        if not self.running:
+            self.snapshot = self.sample()
+
+    def stop(self):
+        """Stops sampling, waiting for a sample in progress"""
+        if not self.running:
+            return
+        self.running = False
+        WHEEL.cancel(self.timer)
+        self.timer = None
+
+    def close(self):
+        """Stops the sampler and releases the providers"""
+        self.stop()
+        for provider in self.providers + (self.pending_providers or []):
+            provider.close()
+
+# Values last sent to a keyboard, used by the adaptive update rate
+class SendState:
+    __slots__ = ('cpu', 'mem', 'last_send', 'fast')
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.mem = 0.0
+        self.last_send = None
+        self.fast = False
+
+# Delta-aware update rate
+# A frame is sent only when a value moved by at least `resolution` points since the last frame sent
+# to that keyboard (comparing with the last sent value gives the hysteresis: jitter never triggers a send),
+# right away and at fast_interval after a jump of `spike` points, and at least every `keepalive` seconds.
+class AdaptiveRate:
+    def __init__(self, resolution=1.0, spike=10.0, fast_interval=0.1, keepalive=2.0):
+        self.resolution = resolution
+        self.spike = spike
+        self.fast_interval = fast_interval
+        self.keepalive = keepalive
+
+    def should_send(self, state, snapshot, now):
+        """Tells if the snapshot differs enough from the last frame sent (or if a keep-alive is due)"""
+        if state.last_send is None or now - state.last_send >= self.keepalive:
+            return True
+        return abs(snapshot.cpu - state.cpu) >= self.resolution or abs(snapshot.mem - state.mem) >= self.resolution
+
+    def sent(self, state, snapshot, now):
+        """Records a frame sent to the keyboard"""
+        state.fast = state.last_send is not None and \
+            max(abs(snapshot.cpu - state.cpu), abs(snapshot.mem - state.mem)) >= self.spike
+        state.cpu = snapshot.cpu
+        state.mem = snapshot.mem
+        state.last_send = now
+
+    def delay(self, state, interval):
+        """Returns the time before the next check: shorter while the load is moving quickly"""
+        return self.fast_interval if state.fast else interval
+
+# Outgoing frame of one client
+# The frame is packed in place into a preallocated buffer and sent through a memoryview, so a frame
+# allocates no bytes object; a partial send is resumed from where it stopped instead of breaking the framing.
+# The broadcast engine packs each frame once for all the clients and only loads it here.
+class FrameWriter:
+    __slots__ = ('profile', 'frame', 'buffer', 'view', 'data', 'offset', 'snapshot')
+
+    def __init__(self, profile=PROFILES[DEFAULT_PROFILE]):
+        self.profile = profile
+        self.frame = profile.frame
+        self.buffer = bytearray(self.frame.size)
+        self.view = memoryview(self.buffer)
+        # Frame being sent: the buffer, or a frame shared by every client of the profile
+        self.data = self.view
+        # Nothing pending until the first frame is packed
+        self.offset = self.frame.size
+        # Snapshot of the frame in the buffer
+        self.snapshot = None
+
+    @property
+    def pending(self):
+        """Tells if part of the current frame is still to be sent"""
+        return self.offset < self.frame.size
+
+    def pack(self, snapshot):
+        """Packs the frame of a snapshot into the buffer (the previous frame must have been sent)"""
+        self.profile.pack_into(self.buffer, snapshot)
+        self.load(self.view, snapshot)
+
+    def load(self, data, snapshot):
+        """Sets an already packed frame of a snapshot as the frame to send (the previous one must have been sent)"""
+        self.data = data
+        self.snapshot = snapshot
+        self.offset = 0
+
+    def write(self, sock):
+        """Sends the rest of the frame with one send() call, returns True once the whole frame is sent"""
+        self.offset += sock.send(memoryview(self.data)[self.offset:] if self.offset else self.data)
+        return self.offset >= self.frame.size
+
+# Read-only copy of a client record, returned by ClientRegistry.snapshot()
+ClientInfo = namedtuple('ClientInfo', ['address', 'connected_at', 'last_send', 'last_ack', 'frames_sent', 'acks_received',
+                                       'ack_timeouts', 'bytes_sent', 'bytes_received', 'profile', 'ack_latency'])
+
+# State of a connected client, updated only by the thread (or loop) serving it
+class ClientRecord:
+    __slots__ = ('socket', 'fd', 'address', 'connected_at', 'last_send', 'last_ack', 'awaiting_ack', 'frames_sent',
+                 'acks_received', 'ack_timeouts', 'bytes_sent', 'bytes_received', 'send_state', 'profile', 'writer',
+                 'hello', 'handshake_until', 'ack_latency', 'recorder', 'unacked_since')
+
+    def __init__(self, client_socket, client_address, profile=PROFILES[DEFAULT_PROFILE], recorder=None):
+        now = time.monotonic()
+        self.socket = client_socket
+        # Kept apart: fileno() returns -1 once the socket is closed
+        self.fd = client_socket.fileno()
+        self.address = client_address
+        self.connected_at = now
+        self.last_send = 0.0
+        self.last_ack = now
+        self.awaiting_ack = False
+        # Start of the oldest frame not acknowledged (or not fully written) yet, None when all are: the stall timer
+        # runs from there, so a long pause between frames (adaptive keep-alive) does not count
+        self.unacked_since = None
+        self.frames_sent = 0
+        self.acks_received = 0
+        self.ack_timeouts = 0
+        # Time between the last frame and its ACK, in seconds (None until the first ACK)
+        self.ack_latency = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send_state = SendState()
+        self.profile = profile
+        self.writer = FrameWriter(profile)
+        # Handshake bytes received so far, and the time after which the handshake is given up (broadcast engine)
+        self.hello = b''
+        self.handshake_until = 0.0
+        # Optional FrameRecorder receiving the frames and ACK latencies (--record)
+        self.recorder = recorder
+
+    def set_profile(self, profile):
+        """Switches the client to another protocol profile (before its first frame)"""
+        self.profile = profile
+        self.writer = FrameWriter(profile)
+
+    def sending(self, now):
+        """Records the start of a frame"""
+        if self.unacked_since is None:
+            self.unacked_since = now
+
+    def stalled(self, now, timeout):
+        """Tells if a frame has been waiting for its ACK (or to be written) for more than timeout seconds"""
+        return self.unacked_since is not None and now - self.unacked_since > timeout
+
+    def frame_sent(self, now, size):
+        """Records a frame sent to the client"""
+        self.last_send = now
+        self.frames_sent += 1
+        self.bytes_sent += size
+        if self.recorder is not None:
+            self.recorder.frame(self.writer.snapshot)
+        if self.profile.ack_size:
+            self.awaiting_ack = True
+        else:
+            # Without ACKs, a frame fully written is the only sign of life
+            self.last_ack = now
+            self.unacked_since = None
+
+    def ack_received(self, now, size):
+        """Records ACK bytes received from the client, returns the number of ACKs they hold"""
+        # Several ACKs can arrive in one read (broadcast engine); a partial one counts as one
+        acks = max(1, size // (self.profile.ack_size or 1))
+        if self.awaiting_ack:
+            self.ack_latency = now - self.last_send
+            if self.recorder is not None:
+                self.recorder.ack(self.ack_latency)
+        self.last_ack = now
+        self.awaiting_ack = False
+        self.unacked_since = None
+        self.acks_received += acks
+        self.bytes_received += size
+        return acks
+
+    def info(self):
+        """Returns a read-only copy of the record"""
+        return ClientInfo(self.address, self.connected_at, self.last_send, self.last_ack, self.frames_sent,
+                          self.acks_received, self.ack_timeouts, self.bytes_sent, self.bytes_received, self.profile.name,
+                          self.ack_latency)
+
+# Registry of the connected clients, keyed by file descriptor
+# Adding and removing are O(1) and serialized by a lock; on_change is called with the new count
+# while holding the lock, so the counts reported to the GUI always arrive in order.
+class ClientRegistry:
+    def __init__(self, on_change=None):
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._per_ip = {}
+        self.on_change = on_change
+
+    def __len__(self):
+        return len(self._clients)
+
+    def add(self, record):
+        """Registers a client
+        A record still registered under the same fd belongs to a closed socket whose fd was reused:
+        it is replaced, and no longer counted for its address."""
+        with self._lock:
+            stale = self._clients.get(record.fd)
+            if stale is not None:
+                self._uncount(stale)
+            self._clients[record.fd] = record
+            ip = record.address[0]
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+            self._notify()
+
+    def remove(self, record):
+        """Unregisters a client, returns False if it was not registered (e.g. already cleared by stop)"""
+        with self._lock:
+            if self._clients.get(record.fd) is not record:
+                return False
+            del self._clients[record.fd]
+            self._uncount(record)
+            self._notify()
+            return True
+
+    def _uncount(self, record):
+        ip = record.address[0]
+        remaining = self._per_ip.get(ip, 0) - 1
+        if remaining > 0:
+            self._per_ip[ip] = remaining
+        else:
+            self._per_ip.pop(ip, None)
+
+    def clear(self):
+        """Unregisters every client and returns their records"""
+        with self._lock:
+            records = list(self._clients.values())
+            self._clients.clear()
+            self._per_ip.clear()
+            self._notify()
+            return records
+
+    def count_for_ip(self, ip):
+        """Returns the number of clients connected from an address"""
+        return self._per_ip.get(ip, 0)
+
+    def records(self):
+        """Returns the live records (for the engines)"""
+        with self._lock:
+            return list(self._clients.values())
+
+    def snapshot(self):
+        """Returns read-only copies of the records (for the GUI and the metrics)"""
+        with self._lock:
+            return [record.info() for record in self._clients.values()]
+
+    def _notify(self):
+        if self.on_change:
+            self.on_change(len(self._clients))
+
+# Size and number of the rotated log files
+LOG_FILE_MAX_BYTES = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Minimum time between two repetitive per-client lines ("Data sent", ACKs) in debug mode
+LOG_RATE_LIMIT = 5.0
+
+def create_log_file_handler(path):
+    """Creates a handler writing to a rotating file, so the history is kept on disk instead of in memory"""
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_MAX_BYTES,
+                                                   backupCount=LOG_FILE_BACKUPS, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    return handler
+
+# Logging handler forwarding the formatted messages to a callback (the GUI)
+class CallbackHandler(logging.Handler):
+    def __init__(self, get_callback):
+        super().__init__()
+        # The callback is looked up at emit time, since the GUI sets it after the server is created
+        self.get_callback = get_callback
+
+    def emit(self, record):
+        callback = self.get_callback()
+        if callback:
+            try:
+                callback(self.format(record))
+            except Exception:
+                self.handleError(record)
+
+# Queue handler leaving the formatting to the listener thread
+# The stock QueueHandler.prepare() merges the arguments into the message (and renders the traceback) on the
+# calling thread; the record is queued as is instead. The arguments are then formatted a little later, so they
+# must not be changed after the call (the server only logs numbers, strings, addresses and exceptions).
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# TCP keepalive of the client sockets: first probe after KEEPALIVE_IDLE seconds of silence,
+# then every KEEPALIVE_INTERVAL seconds, the connection is dropped after KEEPALIVE_COUNT missed probes
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 3
+KEEPALIVE_COUNT = 3
+
+def configure_client_socket(client_socket, nodelay=True):
+    """Enables TCP keepalive, so the OS detects keyboards that vanished without closing the connection,
+    and sets TCP_NODELAY, so the 8-byte frames are not held back by Nagle's algorithm while an ACK is pending"""
+    if is_unix_socket(client_socket):
+        # Local bridge, neither applies
+        return
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        # Linux
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, KEEPALIVE_IDLE)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    if hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows: (on, idle ms, interval ms)
+        client_socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+
+# Server class for the Keyboard Data Server
+# This class handles the server operations, including starting, stopping, and managing client connections.
+class KeyboardDataServer:
+    def __init__(self, host='0.0.0.0', port=1648, debug=False, sampler=None, sample_interval=0.5, engine='threads',
+                 tick_interval=0.3, ack_timeout=1.0, stall_timeout=5.0, log_file=None, log_rate_limit=LOG_RATE_LIMIT,
+                 adaptive=None, metrics_port=None, metrics_host='127.0.0.1',
+                 max_clients=64, max_clients_per_ip=8, backlog=16, tcp_nodelay=True, profiles=None,
+                 default_profile=DEFAULT_PROFILE, client_profiles=None, handshake_timeout=0.0, recorder=None,
+                 listen=None, reuse_port=False):
+        self.host = host
+        self.port = port
+        # Addresses to listen on ('HOST:PORT', '[IPV6]:PORT', 'HOST' on the default port, 'unix:PATH'),
+        # host alone by default; with reuse_port other processes can bind the same TCP addresses (Linux sharding)
+        self.listen = listen or [host]
+        self.reuse_port = reuse_port
+        # Connection engine: 'threads' (one thread per client), 'asyncio' (single event loop)
+        # or 'broadcast' (one thread pushing the same frame to every client per tick)
+        if engine not in ('threads', 'asyncio', 'broadcast'):
+            raise ValueError(f"Unknown engine: {engine}")
+        self.engine = engine
+        # Timings: frame period, ACK wait before resending, and no-ACK time before dropping a client
+        self.tick_interval = tick_interval
+        self.ack_timeout = ack_timeout
+        self.stall_timeout = stall_timeout
+        # Admission control: connections over these limits are closed right after accept (None = no limit)
+        self.max_clients = max_clients
+        self.max_clients_per_ip = max_clients_per_ip
+        self.backlog = backlog
+        # Send the frames immediately instead of letting Nagle's algorithm wait for the previous ACK
+        self.tcp_nodelay = tcp_nodelay
+        # Protocol profiles {name: ProtocolProfile}: frame layout, rate and ACKs of each keyboard model.
+        # A client gets the profile of its handshake, else the one of its IP ({ip: ProtocolProfile}), else the default
+        self.profiles = profiles if profiles is not None else PROFILES
+        if default_profile not in self.profiles:
+            raise ValueError(f"Unknown profile: {default_profile}")
+        self.default_profile = self.profiles[default_profile]
+        self.client_profiles = client_profiles or {}
+        # Seconds to wait for a 'HELLO <profile>' line before the first frame (0 = no handshake)
+        self.handshake_timeout = handshake_timeout
+        # Optional FrameRecorder appending every frame and ACK latency to a recording
+        self.recorder = recorder
+        # Optional AdaptiveRate: skip frames that would not change the display
+        self.adaptive = adaptive
+        self.wakeup_sockets = None
+        self.loop = None
+        self.async_task = None
+        self.client_tasks = set()
+        # Shared metrics sampler, created here only if the caller did not provide one
+        self.owns_sampler = sampler is None
+        self.sampler = sampler if sampler is not None else MetricsSampler(sample_interval)
+        # Counters and histograms, always recorded; exported on /metrics only if metrics_port is set
+        self.metrics = ServerMetrics()
+        self.sampler.metrics = self.metrics
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_server = None
+        self.server_sockets = []
+        self.unix_paths = []
+        # Numbers the clients of the Unix-domain sockets, which have no address of their own
+        self.unix_clients = itertools.count(1)
+        # Connected clients, the count is reported through on_connection_change
+        self.clients = ClientRegistry(self.notify_connection_change)
+        self.running = False
+        self.debug = debug
+        self.server_thread = None
+        self.on_log = None
+        self.on_connection_change = None
+        self.on_status_change = None
+        self.on_system_stats = None
+        # Periodic push of the stats to the GUI, and the screen lock check making the server idle
+        self.stats_timer = None
+        self.lock_monitor = ScreenLockMonitor()
+        self.setup_logging(log_file)
+        # Per-client rate limiting of the repetitive debug lines: {address: {kind: [last_time, suppressed]}}
+        self.log_rate_limit = log_rate_limit
+        self.log_throttle = {}
+        
+    def setup_logging(self, log_file=None):
+        """Creates the logger: records are queued by the caller, then formatted and written by a listener thread"""
+        # Standalone logger, so several servers in one process do not share handlers
+        self.logger = logging.Logger('skyloong.server', logging.DEBUG)
+        self.log_queue = queue.SimpleQueue()
+        self.logger.addHandler(DeferredQueueHandler(self.log_queue))
+
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        handlers = [console_handler, CallbackHandler(lambda: self.on_log)]
+        # Optional on-disk rotating log
+        if log_file:
+            handlers.append(create_log_file_handler(log_file))
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *handlers)
+        self.log_listener.start()
+
+    def close(self):
+        """Flushes the pending log records and stops the log listener"""
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            for handler in self.log_listener.handlers:
+                handler.close()
+            self.log_listener = None
+
+    def log(self, message, *args, always_show=False):
+        """Logs the message only if in debug mode or if always_show is True, formatting it lazily with args"""
+        if self.debug or always_show:
+            self.logger.log(logging.INFO if always_show else logging.DEBUG, message, *args)
+            
+    def log_throttled(self, client_address, kind, message, *args):
+        """Logs a repetitive debug line at most once per log_rate_limit seconds for each client"""
+        if not self.debug:
+            return
+        now = time.monotonic()
+        throttle = self.log_throttle.setdefault(client_address, {})
+        state = throttle.get(kind)
+        if state is not None and now - state[0] < self.log_rate_limit:
+            state[1] += 1
+            return
+        suppressed = state[1] if state is not None else 0
+        throttle[kind] = [now, 0]
+        if suppressed:
+            self.log(message + " (%d similar lines suppressed)", *args, suppressed)
+        else:
+            self.log(message, *args)
+            
+    def start(self):
+        """Starts the server and listens for connections"""
+        if self.running:
+            return False
+            
+        try:
+            # Create the listening sockets, non-blocking: every engine waits for connections in a selector
+            self.server_sockets = create_listen_sockets(self.listen, self.port, self.backlog, self.reuse_port)
+            self.unix_paths = unix_socket_paths(self.server_sockets)
+            for server_socket in self.server_sockets:
+                server_socket.setblocking(False)
+            self.running = True
+            # In adaptive mode the sampler also speeds up after a spike
+            if self.adaptive is not None and self.sampler.fast_interval is None:
+                self.sampler.fast_interval = self.adaptive.fast_interval
+                self.sampler.spike_threshold = self.adaptive.spike
+            self.sampler.start()
+            # Idle until the first keyboard connects
+            WHEEL.set_idle('no-clients', len(self.clients) == 0)
+            self.lock_monitor.start()
+            if self.on_system_stats:
+                self.stats_timer = WHEEL.schedule(self.push_system_stats, self.sampler.interval, name='gui-stats')
+            
+            self.log(f"Server stared on {', '.join(describe_socket(sock) for sock in self.server_sockets)}",
+                     always_show=True)
+            
+            # Optional Prometheus endpoint, the server keeps running without it
+            if self.metrics_port:
+                try:
+                    self.metrics_server = MetricsHTTPServer(self.metrics, self.clients.snapshot, self.sampler.history,
+                                                            self.metrics_host, self.metrics_port)
+                    self.metrics_server.start()
+                    self.log(f"Metrics available on http://{self.metrics_host}:{self.metrics_port}/metrics",
+                             always_show=True)
+                except Exception as e:
+                    self.metrics_server = None
+                    self.log(f"Unable to start the metrics endpoint: {e}", always_show=True)
+            
+            if self.on_status_change:
+                self.on_status_change(True)
+                
+            # Start the server thread
+            if self.engine == 'asyncio':
+                # asyncio is imported by its engine only, it is the slowest import of the headless server
+                import asyncio
+                # The loop and its main task exist before the thread runs, so stop() can always cancel it
+                self.loop = asyncio.new_event_loop()
+                self.async_task = self.loop.create_task(self.serve_async())
+                self.server_thread = threading.Thread(target=self.run_async_server)
+            elif self.engine == 'broadcast':
+                # The socket pair lets stop() wake the selector immediately
+                self.wakeup_sockets = socket.socketpair()
+                self.server_thread = threading.Thread(target=self.run_broadcast_server)
+            else:
+                # The accept loop blocks in a selector until a connection arrives or stop() wakes it
+                self.wakeup_sockets = socket.socketpair()
+                self.server_thread = threading.Thread(target=self.run_server)
+            self.server_thread.daemon = True
+            self.server_thread.start()
+            
+            return True
+                
+        except Exception as e:
+            self.log(f"Error during the starting of the server: {e}", always_show=True)
+            self.running = False
+            close_listen_sockets(self.server_sockets, self.unix_paths)
+            return False
+    
+    def refusal_reason(self, client_address):
+        """Returns why a new client is over the connection limits, or None if it can be accepted"""
+        if self.max_clients is not None and len(self.clients) >= self.max_clients:
+            return f"server full ({self.max_clients} clients)"
+        if self.max_clients_per_ip is not None:
+            if self.clients.count_for_ip(client_address[0]) >= self.max_clients_per_ip:
+                return f"too many connections from {client_address[0]} ({self.max_clients_per_ip})"
+        return None
+
+    def admit_client(self, client_socket, client_address):
+        """Applies the connection limits: returns True if the client is accepted, otherwise closes it"""
+        reason = self.refusal_reason(client_address)
+        if reason is not None:
+            self.metrics.inc('connections_rejected_total')
+            self.log(f"Connection from {client_address} rejected: {reason}", always_show=True)
+            try:
+                client_socket.close()
+            except:
+                pass
+            return False
+
+        try:
+            configure_client_socket(client_socket, self.tcp_nodelay)
+        except (OSError, AttributeError) as e:
+            self.log("Unable to configure the socket of %s: %s", client_address, e)
+        return True
+
+    def reconfigure(self, settings, changed):
+        """Applies reloaded settings to the running server without dropping the keyboards
+        settings holds every setting of server_config.SETTINGS, changed the names of the live ones to apply"""
+        # Check everything that can fail first, so an invalid file changes nothing
+        if 'profile' in changed and settings['profile'] not in self.profiles:
+            raise ValueError(f"Unknown profile: {settings['profile']}")
+        client_profiles = None
+        if 'client_profile' in changed:
+            client_profiles = parse_client_profiles(settings['client_profile'], self.profiles)
+        if 'smooth' in changed and settings['smooth'] and self.sampler.history is None:
+            raise ValueError("smooth needs the history, restart the server with history enabled")
+        providers = create_providers(settings['metrics']) if 'metrics' in changed else None
+
+        for name in ('debug', 'tick_interval', 'ack_timeout', 'stall_timeout', 'tcp_nodelay', 'handshake_timeout'):
+            if name in changed:
+                setattr(self, name, settings[name])
+        # 0 means no limit, as on the command line
+        for name in ('max_clients', 'max_clients_per_ip'):
+            if name in changed:
+                setattr(self, name, settings[name] or None)
+        if changed & {'adaptive', 'resolution', 'keepalive'}:
+            adaptive = None
+            if settings['adaptive']:
+                adaptive = AdaptiveRate(resolution=settings['resolution'], keepalive=settings['keepalive'])
+                self.sampler.spike_threshold = adaptive.spike
+            self.sampler.fast_interval = adaptive.fast_interval if adaptive is not None else None
+            # One assignment: the engines read it without a lock, once per frame
+            self.adaptive = adaptive
+        if 'profile' in changed:
+            self.default_profile = self.profiles[settings['profile']]
+        if client_profiles is not None:
+            self.client_profiles = client_profiles
+        if 'sample_interval' in changed:
+            self.sampler.set_interval(settings['sample_interval'])
+        if 'smooth' in changed:
+            self.sampler.smoothing = settings['smooth']
+        if providers is not None:
+            self.sampler.replace_providers(providers)
+        self.log(f"Configuration reloaded: {', '.join(sorted(changed))}", always_show=True)
+
+    def profile_for(self, client_address):
+        """Returns the profile configured for a client address, or the default one"""
+        return self.client_profiles.get(client_address[0], self.default_profile)
+
+    def ack_timeout_for(self, profile):
+        """Returns the time to wait for the ACK of a frame"""
+        return profile.ack_timeout or self.ack_timeout
+
+    def apply_handshake(self, client, data):
+        """Switches a client to the profile named by its handshake line, if any"""
+        name = parse_hello(data)
+        if name is None:
+            if data:
+                self.log("Ignored handshake from %s: %s", client.address, data[:HELLO_MAX_SIZE])
+            return
+        if name not in self.profiles:
+            self.log(f"Unknown profile '{name}' from {client.address}, using {client.profile.name}", always_show=True)
+            return
+        client.set_profile(self.profiles[name])
+        self.log(f"Client {client.address} uses the profile {name}", always_show=True)
+
+    def read_handshake(self, client):
+        """Waits for the optional handshake line of a blocking client"""
+        data = b''
+        deadline = time.monotonic() + self.handshake_timeout
+        try:
+            while b'\n' not in data and len(data) < HELLO_MAX_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                client.socket.settimeout(remaining)
+                chunk = client.socket.recv(HELLO_MAX_SIZE - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        self.apply_handshake(client, data)
+
+    def client_address(self, client_socket, address):
+        """Returns the address of a new client; those of a Unix-domain socket get ('unix:PATH', number)"""
+        if is_unix_socket(client_socket):
+            return (describe_socket(client_socket), next(self.unix_clients))
+        if address[0].startswith(IPV4_MAPPED_PREFIX) and '.' in address[0]:
+            # IPv4 client of a dual-stack socket: same address as on an IPv4 socket, for the profiles and limits
+            return (address[0][len(IPV4_MAPPED_PREFIX):], address[1])
+        return address
+
+    def notify_connection_change(self, num_connections):
+        """Forwards the number of connected clients to the GUI, the server is idle without any"""
+        if self.running:
+            WHEEL.set_idle('no-clients', num_connections == 0)
+        if self.on_connection_change:
+            self.on_connection_change(num_connections)
+
+    def push_system_stats(self):
+        """Sends the latest CPU and memory usage to the GUI (timer callback)"""
+        if self.on_system_stats:
+            snapshot = self.sampler.snapshot
+            self.on_system_stats(snapshot.cpu, snapshot.mem)
+
+    def run_server(self):
+        """Main loop of the server (threads engine)"""
+        self.accept_connections()
+            
+    def accept_connections(self):
+        """Accept incoming client connections, sleeping until one arrives (no polling)"""
+        selector = selectors.DefaultSelector()
+        wakeup_socket = self.wakeup_sockets[0]
+        for server_socket in self.server_sockets:
+            selector.register(server_socket, selectors.EVENT_READ)
+        selector.register(wakeup_socket, selectors.EVENT_READ)
+        try:
+            self.accept_loop(selector, wakeup_socket)
+        finally:
+            # This thread owns the listening sockets, close them here
+            selector.close()
+            close_listen_sockets(self.server_sockets, self.unix_paths)
+            for sock in self.wakeup_sockets:
+                try:
+                    sock.close()
+                except:
+                    pass
+
+    def accept_loop(self, selector, wakeup_socket):
+        """Accepts the connections signalled by the selector until the server stops"""
+        while self.running:
+            try:
+                for key, events in selector.select():
+                    if key.fileobj is wakeup_socket:
+                        # Woken up by stop()
+                        wakeup_socket.recv(64)
+                        continue
+                    try:
+                        # Accept a new client connection
+                        client_socket, client_address = key.fileobj.accept()
+                        client_address = self.client_address(client_socket, client_address)
+                        # The listening sockets are non-blocking, the client threads use blocking sends with timeouts
+                        client_socket.setblocking(True)
+                        if not self.admit_client(client_socket, client_address):
+                            continue
+                        self.log(f"New connection from {client_address}", always_show=True)
+                        self.metrics.inc('connections_total')
+
+                        # Register the client (this notifies the GUI about the new connection)
+                        client = ClientRecord(client_socket, client_address, self.profile_for(client_address),
+                                              self.recorder)
+                        self.clients.add(client)
+
+                        # Start a new thread to handle the client
+                        client_thread = threading.Thread(
+                            target=self.handle_client, 
+                            args=(client,)
+                        )
+                        client_thread.daemon = True
+                        client_thread.start()
+
+                    # The connection went away before accept(), or another worker process took it
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    
+            except Exception as e:
+                # If the server is still running, log the error
+                if self.running:
+                    self.metrics.inc('accept_errors_total')
+                    self.log("Error in accepting the connection: %s", e)
+    
+    def handle_client(self, client):
+        """Handles communication with a connected client"""
+        client_socket, client_address = client.socket, client.address
+        send_state = client.send_state
+        try:
+            # The keyboard may announce its model before the first frame
+            if self.handshake_timeout:
+                self.read_handshake(client)
+            profile = client.profile
+            timeout = None
+            while self.running:
+                # Also bounds the sends, so a keyboard that stopped reading is detected
+                # (set only when it changes, the ACK timeout can be reloaded while running)
+                if timeout != self.ack_timeout_for(profile):
+                    timeout = self.ack_timeout_for(profile)
+                    client_socket.settimeout(timeout)
+
+                # Take the latest snapshot, the frame is packed in the layout of the client's profile
+                snapshot = self.sampler.snapshot
+                
+                # In adaptive mode, skip the frame if the display would not change
+                now = time.monotonic()
+                # Read once per frame: a reload replaces it
+                adaptive = self.adaptive
+                if adaptive is not None and not adaptive.should_send(send_state, snapshot, now):
+                    time.sleep(aligned_delay(self.tick_interval))
+                    continue
+                
+                # Send the data to the client
+                client.writer.pack(snapshot)
+                client.sending(now)
+                if not self.send_frame(client):
+                    self.log(f"Client {client_address} stalled, frame not sent for {self.stall_timeout}s",
+                             always_show=True)
+                    break
+                sent_at = time.perf_counter()
+                client.frame_sent(now, profile.frame.size)
+                self.metrics.inc('frames_sent_total')
+                if adaptive is not None:
+                    adaptive.sent(send_state, snapshot, now)
+                
+                # Log the sent data (detailed only in debug mode)
+                self.log_throttled(client_address, 'sent', "Data sent to: %s: CPU: %s%%, Memory: %s%%",
+                                   client_address, snapshot.cpu, snapshot.mem)
+                
+                # A keyboard without ACKs just gets the next frame after the frame period
+                if not profile.ack_size:
+                    time.sleep(aligned_delay(self.frame_delay(client, adaptive)))
+                    continue
+                
+                # Wait for the client's response (ACK - 1 byte) (as in the original app)
+                try:
+                    response = client_socket.recv(profile.ack_size)
+                    if not response:
+                        self.log(f"Client {client_address} disconnected", always_show=True)
+                        break
+                    client.ack_received(time.monotonic(), len(response))
+                    self.metrics.inc('acks_received_total')
+                    self.metrics.observe('ack_latency_seconds', time.perf_counter() - sent_at)
+                    
+                    if self.debug:
+                        self.log_throttled(client_address, 'ack', "Ricevuto da %s: %s", client_address, response.hex())
+                except socket.timeout:
+                    # If the client does not respond within the timeout, log the error
+                    client.ack_timeouts += 1
+                    self.metrics.inc('ack_timeouts_total')
+                    if not self.running:
+                        break
+                    # A keyboard that stopped answering is dropped
+                    if client.stalled(time.monotonic(), self.stall_timeout):
+                        self.log(f"Client {client_address} stalled, no ACK for {self.stall_timeout}s", always_show=True)
+                        break
+                    continue
+                
+                time.sleep(aligned_delay(self.frame_delay(client, adaptive)))
+                
+        except Exception as e:
+            self.log("Error with the client %s: %s", client_address, e)
+        finally:
+            # Unregister the client before closing its socket, so its fd cannot be reused by a new client
+            # while still registered (this notifies the GUI about the disconnection)
+            self.clients.remove(client)
+            try:
+                client_socket.close()
+            except:
+                pass
+            self.log_throttle.pop(client_address, None)
+            self.log(f"Connection with {client_address} closed", always_show=True)
+    
+    def send_frame(self, client):
+        """Sends the packed frame on a blocking socket, resuming after partial writes and send timeouts;
+        returns False if the server stopped or the client stalled before the frame was sent"""
+        writer = client.writer
+        while True:
+            try:
+                if writer.write(client.socket):
+                    return True
+            except socket.timeout:
+                if not self.running or client.stalled(time.monotonic(), self.stall_timeout):
+                    return False
+
+    def run_async_server(self):
+        """Main loop of the asyncio engine, runs the event loop until the server is stopped"""
+        import asyncio
+        loop = self.loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.async_task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log(f"Error in the asyncio engine: {e}", always_show=True)
+        finally:
+            loop.close()
+
+    async def serve_async(self):
+        """Accepts connections and serves every client on one event loop"""
+        import asyncio
+        servers = [await asyncio.start_server(self.handle_client_async, sock=sock) for sock in self.server_sockets]
+        try:
+            # The stats of the GUI are pushed by the timer wheel, the loop only wakes up for the clients
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            # Stop accepting and cancel every client coroutine right away
+            for server in servers:
+                server.close()
+            tasks = list(self.client_tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for server in servers:
+                await server.wait_closed()
+            # The servers closed the sockets, only the Unix-domain socket files are left
+            close_listen_sockets([], self.unix_paths)
+
+    def admit_client_async(self, writer, client_address):
+        """Applies the connection limits to a stream of the asyncio engine"""
+        reason = self.refusal_reason(client_address)
+        if reason is not None:
+            self.metrics.inc('connections_rejected_total')
+            self.log(f"Connection from {client_address} rejected: {reason}", always_show=True)
+            writer.close()
+            return False
+
+        try:
+            configure_client_socket(writer.get_extra_info('socket'), self.tcp_nodelay)
+        except (OSError, AttributeError) as e:
+            self.log("Unable to configure the socket of %s: %s", client_address, e)
+        # drain() then waits until the transport buffer is empty, so the frame buffer can be reused
+        writer.transport.set_write_buffer_limits(high=0)
+        return True
+
+    async def handle_client_async(self, reader, writer):
+        """Handles communication with a connected client (asyncio engine)"""
+        import asyncio
+        client_address = self.client_address(writer.get_extra_info('socket'), writer.get_extra_info('peername'))
+        if not self.admit_client_async(writer, client_address):
+            return
+        task = asyncio.current_task()
+        self.client_tasks.add(task)
+        self.log(f"New connection from {client_address}", always_show=True)
+        self.metrics.inc('connections_total')
+
+        # Register the client (this notifies the GUI about the new connection)
+        client = ClientRecord(writer.get_extra_info('socket'), client_address, self.profile_for(client_address),
+                              self.recorder)
+        self.clients.add(client)
+
+        send_state = client.send_state
+        try:
+            # The keyboard may announce its model before the first frame
+            if self.handshake_timeout:
+                try:
+                    data = await asyncio.wait_for(reader.readline(), timeout=self.handshake_timeout)
+                except (asyncio.TimeoutError, ValueError):
+                    data = b''
+                self.apply_handshake(client, data)
+            profile = client.profile
+            while self.running:
+                # Take the latest snapshot, the frame is packed in the layout of the client's profile
+                snapshot = self.sampler.snapshot
+
+                # In adaptive mode, skip the frame if the display would not change
+                now = time.monotonic()
+                # Read once per frame: a reload replaces it
+                adaptive = self.adaptive
+                if adaptive is not None and not adaptive.should_send(send_state, snapshot, now):
+                    await asyncio.sleep(aligned_delay(self.tick_interval))
+                    continue
+
+                # The transport resumes partial writes itself; drain() returns once the frame is out
+                client.writer.pack(snapshot)
+                client.sending(now)
+                writer.write(client.writer.view)
+                await writer.drain()
+                sent_at = time.perf_counter()
+                client.frame_sent(now, profile.frame.size)
+                self.metrics.inc('frames_sent_total')
+                if adaptive is not None:
+                    adaptive.sent(send_state, snapshot, now)
+
+                # Log the sent data (detailed only in debug mode)
+                self.log_throttled(client_address, 'sent', "Data sent to: %s: CPU: %s%%, Memory: %s%%",
+                                   client_address, snapshot.cpu, snapshot.mem)
+
+                # A keyboard without ACKs just gets the next frame after the frame period
+                if not profile.ack_size:
+                    await asyncio.sleep(aligned_delay(self.frame_delay(client, adaptive)))
+                    continue
+
+                # Wait for the client's response (ACK - 1 byte)
+                try:
+                    response = await asyncio.wait_for(reader.read(profile.ack_size),
+                                                      timeout=self.ack_timeout_for(profile))
+                except asyncio.TimeoutError:
+                    client.ack_timeouts += 1
+                    self.metrics.inc('ack_timeouts_total')
+                    # A keyboard that stopped answering is dropped
+                    if client.stalled(time.monotonic(), self.stall_timeout):
+                        self.log(f"Client {client_address} stalled, no ACK for {self.stall_timeout}s", always_show=True)
+                        break
+                    continue
+                if not response:
+                    self.log(f"Client {client_address} disconnected", always_show=True)
+                    break
+                client.ack_received(time.monotonic(), len(response))
+                self.metrics.inc('acks_received_total')
+                self.metrics.observe('ack_latency_seconds', time.perf_counter() - sent_at)
+
+                if self.debug:
+                    self.log_throttled(client_address, 'ack', "Ricevuto da %s: %s", client_address, response.hex())
+
+                await asyncio.sleep(aligned_delay(self.frame_delay(client, adaptive)))
+
+        except asyncio.CancelledError:
+            # The server is stopping, exit quietly
+            pass
+        except Exception as e:
+            self.log("Error with the client %s: %s", client_address, e)
+        finally:
+            self.client_tasks.discard(task)
+            # Unregister the client before closing its socket (this notifies the GUI about the disconnection)
+            self.clients.remove(client)
+            writer.close()
+            self.log_throttle.pop(client_address, None)
+            self.log(f"Connection with {client_address} closed", always_show=True)
+
+    def run_broadcast_server(self):
+        """Main loop of the broadcast engine: accepts, reads ACKs and sends one frame per tick to every client"""
+        selector = selectors.DefaultSelector()
+        # The sockets of this run: after a quick stop() and start() the attributes already hold the next run's
+        wakeup_sockets, listen_sockets, unix_paths = self.wakeup_sockets, self.server_sockets, self.unix_paths
+        wakeup_socket = wakeup_sockets[0]
+        server_sockets = set(listen_sockets)
+        for server_socket in server_sockets:
+            selector.register(server_socket, selectors.EVENT_READ)
+        selector.register(wakeup_socket, selectors.EVENT_READ)
+
+        next_tick = time.monotonic()
+        try:
+            while self.running:
+                # Without any keyboard there is nothing to send: sleep until a connection arrives
+                timeout = max(0.0, next_tick - time.monotonic()) if len(self.clients) else None
+                for key, events in selector.select(timeout):
+                    if key.fileobj in server_sockets:
+                        self.accept_broadcast_client(selector, key.fileobj)
+                    elif key.fileobj is wakeup_socket:
+                        wakeup_socket.recv(64)
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            self.write_broadcast_frame(selector, key.data, time.monotonic())
+                        if events & selectors.EVENT_READ and key.data.socket.fileno() >= 0:
+                            self.read_broadcast_ack(selector, key.data)
+
+                now = time.monotonic()
+                if now >= next_tick:
+                    # Read once per tick: a reload replaces it
+                    adaptive = self.adaptive
+                    spike = self.broadcast_frame(selector, now, adaptive)
+                    # Tick faster while the load is moving quickly (adaptive mode); the ticks are aligned with
+                    # the timer wheel, and missed ones are skipped rather than caught up
+                    next_tick = now + aligned_delay(adaptive.fast_interval if spike else self.tick_period(), now)
+
+        except Exception as e:
+            if self.running:
+                self.log(f"Error in the broadcast engine: {e}", always_show=True)
+        finally:
+            # The loop owns every socket of this engine, close them here
+            for key in list(selector.get_map().values()):
+                if isinstance(key.data, ClientRecord):
+                    self.drop_broadcast_client(selector, key.data)
+            selector.close()
+            close_listen_sockets(listen_sockets, unix_paths)
+            for sock in wakeup_sockets:
+                try:
+                    sock.close()
+                except:
+                    pass
+
+    def accept_broadcast_client(self, selector, server_socket):
+        """Accepts a pending connection and registers it with the broadcast selector"""
+        try:
+            client_socket, client_address = server_socket.accept()
+            client_address = self.client_address(client_socket, client_address)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            self.metrics.inc('accept_errors_total')
+            self.log("Error in accepting the connection: %s", e)
+            return
+        if not self.admit_client(client_socket, client_address):
+            return
+
+        self.log(f"New connection from {client_address}", always_show=True)
+        self.metrics.inc('connections_total')
+        client_socket.setblocking(False)
+        client = ClientRecord(client_socket, client_address, self.profile_for(client_address), self.recorder)
+        if self.handshake_timeout:
+            client.handshake_until = time.monotonic() + self.handshake_timeout
+        selector.register(client_socket, selectors.EVENT_READ, client)
+        # Register the client (this notifies the GUI about the new connection)
+        self.clients.add(client)
+
+    def read_broadcast_ack(self, selector, client):
+        """Reads the ACK bytes of a client, or drops it if it disconnected"""
+        try:
+            response = client.socket.recv(64)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            self.log("Error with the client %s: %s", client.address, e)
+            self.drop_broadcast_client(selector, client)
+            return
+
+        if not response:
+            self.log(f"Client {client.address} disconnected", always_show=True)
+            self.drop_broadcast_client(selector, client)
+            return
+
+        # Bytes received before the first frame are the handshake
+        if client.handshake_until:
+            client.hello += response
+            if b'\n' in client.hello or len(client.hello) >= HELLO_MAX_SIZE:
+                self.apply_handshake(client, client.hello)
+                client.hello = b''
+                client.handshake_until = 0.0
+            return
+
+        now = time.monotonic()
+        if client.awaiting_ack:
+            self.metrics.observe('ack_latency_seconds', now - client.last_send)
+        # Counted in ACKs, not bytes, as in the other engines
+        self.metrics.inc('acks_received_total', client.ack_received(now, len(response)))
+        if self.debug:
+            self.log_throttled(client.address, 'ack', "Ricevuto da %s: %s", client.address, response.hex())
+
+    def broadcast_frame(self, selector, now, adaptive):
+        """Sends the current frame to every client in one pass, returns True if it carried a spike (adaptive mode)"""
+        snapshot = self.sampler.snapshot
+        # Each frame is packed once per profile, whatever the number of clients (the default one by the sampler)
+        frames = {PROFILES[DEFAULT_PROFILE]: snapshot.packet}
+        spike = False
+        for key in list(selector.get_map().values()):
+            client = key.data
+            if not isinstance(client, ClientRecord):
+                continue
+
+            # A client that has not acknowledged (or not even read) its frames for too long is stalled
+            if client.stalled(now, self.stall_timeout):
+                self.log(f"Client {client.address} stalled, no ACK for {self.stall_timeout}s", always_show=True)
+                self.drop_broadcast_client(selector, client)
+                continue
+
+            # Give the keyboard time to announce its model, then fall back to its configured profile
+            if client.handshake_until:
+                if now < client.handshake_until:
+                    continue
+                self.apply_handshake(client, client.hello)
+                client.hello = b''
+                client.handshake_until = 0.0
+
+            # The rest of the previous frame is sent when the socket becomes writable
+            if client.writer.pending:
+                continue
+
+            # Keep the send/ACK rhythm: wait for the ACK, resend only after the ACK timeout (as in the original app)
+            if client.awaiting_ack:
+                if now - client.last_send < self.ack_timeout_for(client.profile):
+                    continue
+                client.ack_timeouts += 1
+                self.metrics.inc('ack_timeouts_total')
+            # A profile with its own frame period is served on the nearest tick
+            elif client.profile.interval and now - client.last_send < client.profile.interval - self.tick_interval / 2:
+                continue
+
+            # In adaptive mode, skip the frame if the display would not change
+            if adaptive is not None and not adaptive.should_send(client.send_state, snapshot, now):
+                continue
+
+            frame = frames.get(client.profile)
+            if frame is None:
+                frame = frames[client.profile] = client.profile.pack(snapshot)
+            client.writer.load(frame, snapshot)
+            client.sending(now)
+            if not self.write_broadcast_frame(selector, client, now):
+                continue
+            if adaptive is not None:
+                adaptive.sent(client.send_state, snapshot, now)
+                spike = spike or client.send_state.fast
+            self.log_throttled(client.address, 'sent', "Data sent to: %s: CPU: %s%%, Memory: %s%%",
+                               client.address, snapshot.cpu, snapshot.mem)
+        return spike
+
+    def write_broadcast_frame(self, selector, client, now):
+        """Sends the pending frame of a client, returns True once it is complete
+        A partial write registers the socket for EVENT_WRITE, and the rest is sent when it becomes writable."""
+        try:
+            complete = client.writer.write(client.socket)
+        except (BlockingIOError, InterruptedError):
+            complete = False
+        except Exception as e:
+            self.log("Error with the client %s: %s", client.address, e)
+            self.drop_broadcast_client(selector, client)
+            return False
+
+        events = selectors.EVENT_READ if complete else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if selector.get_key(client.socket).events != events:
+            selector.modify(client.socket, events, client)
+        if complete:
+            client.frame_sent(now, client.writer.frame.size)
+            self.metrics.inc('frames_sent_total')
+        return complete
+
+    def tick_period(self):
+        """Returns the frame period, slower while the screen is locked"""
+        if 'locked' in WHEEL.idle_reasons:
+            return max(self.tick_interval, LOCKED_FRAME_INTERVAL)
+        return self.tick_interval
+
+    def frame_delay(self, client, adaptive):
+        """Returns the pause after a frame: the frame period of the client's profile, or the adaptive delay"""
+        interval = client.profile.interval or self.tick_interval
+        if 'locked' in WHEEL.idle_reasons:
+            interval = max(interval, LOCKED_FRAME_INTERVAL)
+        if adaptive is not None:
+            return adaptive.delay(client.send_state, interval)
+        return interval
+
+    def drop_broadcast_client(self, selector, client):
+        """Unregisters and closes a client of the broadcast engine"""
+        try:
+            selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+        # Unregister the client before closing its socket (this notifies the GUI about the disconnection)
+        self.clients.remove(client)
+        try:
+            client.socket.close()
+        except:
+            pass
+        self.log_throttle.pop(client.address, None)
+        self.log(f"Connection with {client.address} closed", always_show=True)
+
+    def get_cpu_percent(self):
+        """Obtains the CPU usage percentage from the shared snapshot"""
+        return self.sampler.snapshot.cpu
+    
+    def get_memory_percent(self):
+        """Obtains the memory usage percentage from the shared snapshot"""
+        return self.sampler.snapshot.mem
+    
+    def get_system_data_packet(self, profile=None):
+        """Returns the data packet with CPU and memory information, in the layout of a profile
+        (by default the pre-packed 8-byte packet of the GK104 Pro)"""
+        snapshot = self.sampler.snapshot
+        if profile is None:
+            return snapshot.packet
+        return profile.pack(snapshot)
+    
+    def stop(self):
+        """Stops the server and closes all connections"""
+        if not self.running:
+            return
+            
+        self.running = False
+
+        # Stop the sampler only if nobody else is reading it
+        if self.owns_sampler:
+            self.sampler.stop()
+        if self.stats_timer is not None:
+            WHEEL.cancel(self.stats_timer)
+            self.stats_timer = None
+        self.lock_monitor.stop()
+        WHEEL.set_idle('no-clients', False)
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+        if self.engine == 'asyncio':
+            # The event loop owns the sockets: cancel its main task, it closes the server and every client
+            if self.loop is not None and not self.loop.is_closed():
+                try:
+                    self.loop.call_soon_threadsafe(self.async_task.cancel)
+                except RuntimeError:
+                    pass
+            # Wait for the loop to close the sockets, so the port is free on return
+            self.join_server_thread()
+            self.clients.clear()
+        elif self.engine == 'broadcast':
+            # The broadcast thread owns the sockets: wake it up, it closes the server and every client;
+            # wait for it so the port is free on return
+            try:
+                self.wakeup_sockets[1].send(b'\0')
+            except:
+                pass
+            self.join_server_thread()
+            self.clients.clear()
+        else:
+            # Close all client connections
+            for client in self.clients.clear():
+                try:
+                    client.socket.close()
+                except:
+                    pass
+            
+            # Wake the accept thread, it closes the server socket; wait for it so the port is free on return
+            try:
+                self.wakeup_sockets[1].send(b'\0')
+            except:
+                pass
+            self.join_server_thread()
+        
+        # Notify the GUI about the server status change (the registry already reported 0 connections)
+        if self.on_status_change:
+            self.on_status_change(False)
+            
+        self.log("Server stopped", always_show=True)
+
+    def join_server_thread(self):
+        """Waits for the engine thread to exit (unless called from it), at most one second"""
+        if self.server_thread is not None and self.server_thread is not threading.current_thread():
+            self.server_thread.join(1.0)
+
+# Cold-start targets of the headless server, checked when it is ready to accept connections
+STARTUP_TARGET_MS = 250
+RSS_TARGET_MB = 30
+# A worker of --workers also runs the spawn bootstrap (the main module is imported once more), and they all start
+# at the same time
+WORKER_STARTUP_TARGET_MS = 500
+
+def report_startup(server, target_ms=STARTUP_TARGET_MS):
+    """Logs the time from process creation to listening and the resident memory, warning above the targets"""
+    process = psutil.Process()
+    startup_ms = (time.time() - process.create_time()) * 1000
+    rss_mb = process.memory_info().rss / (1024 * 1024)
+    server.log(f"Ready in {startup_ms:.0f} ms, RSS {rss_mb:.1f} MB", always_show=True)
+    if startup_ms > target_ms:
+        server.log(f"Warning: startup above the {target_ms} ms target", always_show=True)
+    if rss_mb > RSS_TARGET_MB:
+        server.log(f"Warning: RSS above the {RSS_TARGET_MB} MB target", always_show=True)
+
+def serve(args, defaults=None, worker=None, overrides=None):
+    """Runs the server without any GUI until SIGINT/SIGTERM
+    With --config the file is watched, and its changes are applied live (defaults are the values of the
+    settings missing from the file, overrides the values given on the command line, which the file never
+    replaces). With --workers this process only samples the metrics, and worker processes
+    (serve() again, with a sharding.WorkerSpec) serve the keyboards."""
+    if args.workers and worker is None:
+        if not sys.platform.startswith('linux') or not hasattr(socket, 'SO_REUSEPORT'):
+            print("--workers needs Linux (SO_REUSEPORT)")
+            return 2
+        if args.record:
+            print("--record cannot be used with --workers")
+            return 2
+    try:
+        profiles = load_profiles(args.profiles_file) if args.profiles_file else PROFILES
+        client_profiles = parse_client_profiles(args.client_profile, profiles)
+        if args.profile not in profiles:
+            raise ValueError(f"Unknown profile: {args.profile}")
+    except (ValueError, OSError) as e:
+        print(f"Invalid profiles: {e}")
+        return 2
+    history = None
+    # The history and the smoothing of the workers are those of the parent, which samples for them
+    if (args.history or args.smooth) and worker is None:
+        # NumPy is loaded only when the history is enabled, it would double the startup time and memory
+        from metrics_history import MetricsHistory
+        history = MetricsHistory()
+    pool = None
+    try:
+        if args.upstream and args.replay:
+            raise ValueError("--upstream and --replay cannot be used together")
+        if worker is not None:
+            from sharding import create_shared_providers
+            providers = create_shared_providers(worker.segment)
+        elif args.replay:
+            # The recorded values are sampled like live ones, at `replay_speed` times real time
+            from recording import create_replay_providers
+            providers = create_replay_providers(args.replay, args.replay_speed)
+        elif args.upstream:
+            # Relay mode: the keyboards get an aggregate of the upstream servers (or one of them) instead of local metrics
+            from relay import UpstreamPool, create_relay_providers
+            pool = UpstreamPool([node.strip() for nodes in args.upstream for node in nodes.split(',') if node.strip()])
+            providers = create_relay_providers(pool, args.aggregate)
+        else:
+            providers = create_providers(args.metrics)
+        sampler = MetricsSampler(interval=args.sample_interval, providers=providers, history=history,
+                                 smoothing=args.smooth if worker is None else None)
+    except (ValueError, OSError) as e:
+        print(f"Invalid metrics: {e}")
+        return 2
+    STARTUP.mark('sampler ready')
+    if args.workers and worker is None:
+        from sharding import serve_workers
+        return serve_workers(args, defaults, sampler, pool, overrides)
+    listen = [address.strip() for addresses in args.listen or [] for address in addresses.split(',')
+              if address.strip()] or [args.host]
+    metrics_port, log_file = args.metrics_port, args.log_file
+    if worker is not None:
+        # A Unix-domain socket cannot be shared, the first worker serves it
+        if worker.index:
+            listen = [address for address in listen if not address.startswith(UNIX_PREFIX)]
+        # One endpoint and one log file per worker
+        if metrics_port:
+            metrics_port += worker.index
+        if log_file:
+            log_file = f"{log_file}.worker{worker.index}"
+    adaptive = None
+    if args.adaptive:
+        adaptive = AdaptiveRate(resolution=args.resolution, keepalive=args.keepalive)
+    recorder = None
+    if args.record:
+        from recording import FrameRecorder
+        try:
+            recorder = FrameRecorder(args.record)
+        except OSError as e:
+            print(f"Unable to record to {args.record}: {e}")
+            sampler.close()
+            return 2
+    server = KeyboardDataServer(host=args.host, port=args.port, debug=args.debug, engine=args.engine,
+                                sampler=sampler, log_file=log_file, adaptive=adaptive,
+                                metrics_port=metrics_port, metrics_host=args.metrics_host,
+                                max_clients=args.max_clients or None, max_clients_per_ip=args.max_clients_per_ip or None,
+                                backlog=args.backlog, tick_interval=args.tick_interval, ack_timeout=args.ack_timeout,
+                                stall_timeout=args.stall_timeout, tcp_nodelay=args.tcp_nodelay,
+                                profiles=profiles, default_profile=args.profile, client_profiles=client_profiles,
+                                handshake_timeout=args.handshake_timeout, recorder=recorder,
+                                listen=listen, reuse_port=worker is not None)
+    if not server.start():
+        server.close()
+        sampler.close()
+        if recorder is not None:
+            recorder.close()
+        return 1
+    STARTUP.mark('listening')
+    if pool is not None:
+        pool.log = lambda message: server.log(message, always_show=True)
+        pool.start()
+    report_startup(server, STARTUP_TARGET_MS if worker is None else WORKER_STARTUP_TARGET_MS)
+    if args.profile_startup:
+        STARTUP.report(lambda line: server.log(line, always_show=True))
+
+    watcher = None
+    if args.config:
+        overrides = overrides or {}
+        settings = {name: getattr(args, name) for name in SETTINGS}
+
+        def reload_config(config):
+            nonlocal settings
+            # A setting removed from the file goes back to its default, and the command line still wins: only
+            # the settings that changed in the file and are not set on the command line differ from the current ones
+            new_settings = {name: overrides[name] if name in overrides else config.get(name, defaults.get(name))
+                            for name in SETTINGS}
+            changed = {name for name in SETTINGS if new_settings[name] != settings[name]}
+            if pool is not None or args.replay:
+                # The metrics of a relay come from its upstream servers, those of a replay from its recording
+                changed.discard('metrics')
+            if worker is not None:
+                # The parent process samples for the workers
+                changed -= {'metrics', 'smooth'}
+            if not changed:
+                return
+            restart = sorted(changed - LIVE_SETTINGS)
+            if restart:
+                server.log(f"Configuration: {', '.join(restart)} changed, restart the server to apply",
+                           always_show=True)
+            if changed & LIVE_SETTINGS:
+                server.reconfigure(new_settings, changed & LIVE_SETTINGS)
+            settings = new_settings
+
+        watcher = ConfigWatcher(args.config, reload_config,
+                                lambda e: server.log(f"Configuration not reloaded: {e}", always_show=True))
+        watcher.start()
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    # Windows needs a timeout so the signal handlers get a chance to run, elsewhere a signal interrupts the wait
+    while not stop_event.wait(1 if sys.platform == 'win32' else None):
+        pass
+
+    if watcher is not None:
+        watcher.stop()
+    if pool is not None:
+        pool.stop()
+    server.stop()
+    server.close()
+    sampler.close()
+    if recorder is not None:
+        recorder.close()
+    return 0
+
+def diag(args):
+    """Prints the power diagnostics of a running server (wakeups per second, idle state, timers)"""
+    import json
+    import urllib.request
+    url = f"http://{args.metrics_host}:{args.metrics_port}/power?seconds={args.seconds}"
+    try:
+        with urllib.request.urlopen(url, timeout=args.seconds + 5) as response:
+            power = json.load(response)
+    except (OSError, ValueError) as e:
+        print(f"Unable to read {url}: {e} (is the server running with --metrics-port?)")
+        return 1
+    idle = f"yes ({', '.join(power['idle_reasons'])})" if power['idle'] else "no"
+    process = power['process_wakeups_per_second']
+    print(f"Idle: {idle}")
+    print(f"Wakeups/s over {power['seconds']:g}s: timer wheel {power['wheel_wakeups_per_second']:.2f}, "
+          f"process {'n/a' if process is None else f'{process:.2f}'}")
+    print(f"Threads: {power['threads']}")
+    for timer in power['timers']:
+        period = 'suspended' if timer['active_period'] is None else f"every {timer['active_period']:g}s"
+        print(f"  {timer['name']:<14} {period:<16} ({timer['runs']} runs)")
+    return 0
+
+def main(argv=None):
+    """Command line entry point: 'serve' runs headless, 'gui' loads the GUI on demand"""
+    import argparse
+    parser = argparse.ArgumentParser(description="Skyloong Display Server")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="Run the server without GUI")
+    serve_parser.add_argument("--config", help="YAML (or .toml) file with the settings below, reloaded when it changes; "
+                                               "the command line options override it, also when it is reloaded")
+    serve_parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    serve_parser.add_argument("--port", type=int, default=1648, help="TCP port to listen on")
+    serve_parser.add_argument("--listen", action="append", metavar="ADDRESS",
+                              help="Listen on these addresses instead of --host (repeatable or comma-separated): "
+                                   "HOST:PORT, [IPV6]:PORT, HOST (on --port) or unix:PATH; [::] is dual-stack")
+    serve_parser.add_argument("--workers", type=int, default=0,
+                              help="Linux: serve the keyboards from N processes sharing the port (SO_REUSEPORT) "
+                                   "and the sampled metrics (shared memory)")
+    serve_parser.add_argument("--engine", choices=["threads", "asyncio", "broadcast"], default="threads",
+                              help="Connection engine")
+    serve_parser.add_argument("--debug", action="store_true", help="Log frames and ACKs (at most one line per client every 5s)")
+    serve_parser.add_argument("--log-file", help="Also write the log to this file, rotated every 1 MB")
+    serve_parser.add_argument("--metrics", default="cpu,mem",
+                              help="The two values sent to the keyboard, e.g. 'cpu,mem', 'cpu-max,swap', "
+                                   "'load,temp:/sys/class/thermal/thermal_zone0/temp', 'cpu,script:my_command'")
+    serve_parser.add_argument("--adaptive", action="store_true",
+                              help="Send a frame only when a value changes by --resolution points, faster after spikes")
+    serve_parser.add_argument("--resolution", type=float, default=1.0,
+                              help="Smallest change (in percent points) worth a frame in adaptive mode")
+    serve_parser.add_argument("--keepalive", type=float, default=2.0,
+                              help="Maximum time between two frames in adaptive mode")
+    serve_parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port (/metrics)")
+    serve_parser.add_argument("--metrics-host", default="127.0.0.1", help="Address of the metrics endpoint")
+    serve_parser.add_argument("--max-clients", type=int, default=64, help="Maximum connected keyboards (0 = no limit)")
+    serve_parser.add_argument("--max-clients-per-ip", type=int, default=8,
+                              help="Maximum connections from one address (0 = no limit)")
+    serve_parser.add_argument("--backlog", type=int, default=16, help="Listen backlog")
+    serve_parser.add_argument("--sample-interval", type=float, default=0.5, help="Seconds between two metrics samples")
+    serve_parser.add_argument("--tick-interval", type=float, default=0.3, help="Seconds between two frames")
+    serve_parser.add_argument("--ack-timeout", type=float, default=1.0,
+                              help="Seconds to wait for an ACK before sending the next frame")
+    serve_parser.add_argument("--stall-timeout", type=float, default=5.0,
+                              help="Seconds without ACK before a keyboard is dropped")
+    serve_parser.add_argument("--no-tcp-nodelay", dest="tcp_nodelay", action="store_false",
+                              help="Let Nagle's algorithm batch the frames (fewer packets, higher latency)")
+    serve_parser.add_argument("--history", action="store_true",
+                              help="Keep the history of the metrics (1s/10s/1min, up to 24 hours), served on /history")
+    serve_parser.add_argument("--smooth", type=float, metavar="SECONDS",
+                              help="Send the average of the last SECONDS instead of the raw values (enables --history)")
+    serve_parser.add_argument("--profile", default=DEFAULT_PROFILE,
+                              help="Protocol profile of the keyboards (frame layout, rate, ACKs), e.g. 'gk104-pro', 'compact'")
+    serve_parser.add_argument("--profiles-file", help="JSON file with extra protocol profiles")
+    serve_parser.add_argument("--client-profile", action="append", metavar="IP=PROFILE",
+                              help="Profile of the keyboards connecting from an address (repeatable)")
+    serve_parser.add_argument("--handshake-timeout", type=float, default=0.0,
+                              help="Seconds to wait for a 'HELLO <profile>' line from a new keyboard (0 = no handshake)")
+    serve_parser.add_argument("--upstream", action="append", metavar="HOST:PORT",
+                              help="Relay mode: read the metrics of these servers instead of the local ones "
+                                   "(repeatable or comma-separated)")
+    serve_parser.add_argument("--aggregate", default="max",
+                              help="Relay mode: value sent to the keyboards, 'max', 'min', 'avg' or one upstream "
+                                   "HOST:PORT; 'CPU,MEM' sets them separately (e.g. 'max,avg')")
+    serve_parser.add_argument("--record", metavar="FILE",
+                              help="Append every frame sent and every ACK latency to a recording")
+    serve_parser.add_argument("--replay", metavar="FILE",
+                              help="Send the values of a recording instead of the local metrics (loops at the end)")
+    serve_parser.add_argument("--replay-speed", type=float, default=1.0,
+                              help="Replay speed, e.g. 10 plays a recording ten times faster than real time")
+    serve_parser.add_argument("--profile-startup", action="store_true",
+                              help="Print the import and initialization timeline once listening")
+
+    diag_parser = subparsers.add_parser("diag", help="Show the wakeups/sec and idle state of a running server")
+    diag_parser.add_argument("--metrics-host", default="127.0.0.1", help="Address of the server's metrics endpoint")
+    diag_parser.add_argument("--metrics-port", type=int, default=9648, help="Port of the server's metrics endpoint")
+    diag_parser.add_argument("--seconds", type=float, default=2.0, help="Measurement window")
+
+    subparsers.add_parser("gui", help="Run the GUI (default)", add_help=False)
+
+    # The settings of the configuration file replace the defaults, so the command line still overrides them
+    defaults = vars(serve_parser.parse_args([]))
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config")
+    config_args, _ = config_parser.parse_known_args(argv)
+    if config_args.config:
+        try:
+            serve_parser.set_defaults(**load_config(config_args.config))
+        except (OSError, ValueError) as e:
+            parser.error(f"invalid configuration: {e}")
+
+    args, remaining = parser.parse_known_args(argv)
+    if args.command == "serve":
+        if remaining:
+            parser.error(f"unrecognized arguments: {' '.join(remaining)}")
+        # The settings given on the command line, parsed again without any default (None = not given), so a
+        # reload of the file keeps them
+        argv = sys.argv[1:] if argv is None else argv
+        given = serve_parser.parse_args(argv[argv.index("serve") + 1:], argparse.Namespace(**dict.fromkeys(SETTINGS)))
+        overrides = {name: getattr(given, name) for name in SETTINGS if getattr(given, name) is not None}
+        return serve(args, defaults, overrides=overrides)
+    if args.command == "diag":
+        if remaining:
+            parser.error(f"unrecognized arguments: {' '.join(remaining)}")
+        return diag(args)
+
+    # The GUI modules are imported only when the GUI is requested
+    import server_gui
+    return server_gui.main(remaining)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import os
+import socket
+import stat
+from collections import namedtuple
+
+# Prefix of the Unix-domain socket addresses, e.g. unix:/run/skyloong.sock
+UNIX_PREFIX = 'unix:'
+# Prefix of the IPv4 clients of a dual-stack socket, e.g. ::ffff:192.168.1.20
+IPV4_MAPPED_PREFIX = '::ffff:'
+
+# Address to listen on: family (AF_INET, AF_INET6 or AF_UNIX), socket address, and the text it was parsed from
+ListenAddress = namedtuple('ListenAddress', ['family', 'address', 'spec'])
+
+def is_unix_socket(sock):
+    """Tells if a socket is a Unix-domain socket"""
+    return hasattr(socket, 'AF_UNIX') and sock.family == socket.AF_UNIX
+
+def parse_listen_address(spec, default_port):
+    """Parses 'HOST:PORT', '[IPV6]:PORT', 'HOST' (default port) or 'unix:PATH' into a ListenAddress
+    Host names are resolved to their first address; raises ValueError if the address is invalid"""
+    spec = spec.strip()
+    if spec.startswith(UNIX_PREFIX):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError(f"Unix-domain sockets are not supported on this platform: {spec}")
+        path = spec[len(UNIX_PREFIX):]
+        if not path:
+            raise ValueError(f"Missing socket path: {spec}")
+        return ListenAddress(socket.AF_UNIX, path, spec)
+
+    port = default_port
+    if spec.startswith('['):
+        # [::1]:1648 or [::]
+        host, bracket, rest = spec[1:].partition(']')
+        if not bracket or (rest and not rest.startswith(':')):
+            raise ValueError(f"Invalid listen address: {spec}")
+        if rest:
+            port = rest[1:]
+    elif spec.count(':') > 1:
+        # A bare IPv6 address, without port
+        host = spec
+    else:
+        host, colon, rest = spec.partition(':')
+        if colon:
+            port = rest
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError(f"Invalid port in listen address: {spec}")
+    try:
+        family, _, _, _, address = socket.getaddrinfo(host or '0.0.0.0', port, socket.AF_UNSPEC,
+                                                      socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+    except socket.gaierror as e:
+        raise ValueError(f"Invalid listen address {spec}: {e}")
+    return ListenAddress(family, address, spec)
+
+def describe_socket(sock):
+    """Returns the address a listening socket is bound to, as written on the command line"""
+    address = sock.getsockname()
+    if is_unix_socket(sock):
+        return f"{UNIX_PREFIX}{address}"
+    if sock.family == socket.AF_INET6:
+        return f"[{address[0]}]:{address[1]}"
+    return f"{address[0]}:{address[1]}"
+
+def remove_stale_unix_socket(path):
+    """Removes the socket file left by a server that did not exit cleanly
+    Raises OSError if the path is not a socket, or if a server still answers on it."""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(f"{path} exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(f"{path} is in use by another server")
+
+def create_listen_socket(listen_address, backlog, reuse_port=False, dualstack=False):
+    """Creates a listening socket
+    reuse_port lets several processes bind the same TCP address (Linux SO_REUSEPORT: the kernel spreads the
+    connections between them); dualstack makes an IPv6 socket accept IPv4 connections too."""
+    family, address, _ = listen_address
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == getattr(socket, 'AF_UNIX', None):
+            remove_stale_unix_socket(address)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 if dualstack else 1)
+        sock.bind(address)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def create_listen_sockets(specs, default_port, backlog, reuse_port=False):
+    """Creates the listening sockets of every address, closing them all if one fails
+    The IPv6 wildcard [::] also accepts IPv4 (dual-stack), unless 0.0.0.0 is listed with the same port."""
+    addresses = [parse_listen_address(spec, default_port) for spec in specs]
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        raise ValueError("SO_REUSEPORT is not supported on this platform")
+    ipv4_ports = {address.address[1] for address in addresses if address.family == socket.AF_INET}
+    sockets = []
+    try:
+        for address in addresses:
+            dualstack = (address.family == socket.AF_INET6 and address.address[0] == '::' and
+                         address.address[1] not in ipv4_ports)
+            sockets.append(create_listen_socket(address, backlog, reuse_port, dualstack))
+    except:
+        close_listen_sockets(sockets, unix_socket_paths(sockets))
+        raise
+    return sockets
+
+def unix_socket_paths(sockets):
+    """Returns the paths of the Unix-domain sockets, to remove their files once closed"""
+    return [sock.getsockname() for sock in sockets if is_unix_socket(sock)]
+
+def close_listen_sockets(sockets, unix_paths=()):
+    """Closes listening sockets (closing one twice is harmless) and removes the Unix-domain socket files"""
+    for sock in sockets:
+        try:
+            sock.close()
+        except OSError:
+            pass
+    for path in unix_paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
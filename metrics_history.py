@@ -0,0 +1,139 @@
+import threading
+import time
+import numpy as np
+
+# Resolutions of the history: (name, seconds per slot, number of slots)
+# 1 hour at 1s, 6 hours at 10s and 24 hours at 1min, about 200 KB in total
+RESOLUTIONS = (
+    ('1s', 1.0, 3600),
+    ('10s', 10.0, 2160),
+    ('1min', 60.0, 1440),
+)
+
+# Names of the recorded columns, in order
+COLUMNS = ('cpu', 'mem')
+
+# Percentiles returned by MetricsHistory.stats()
+PERCENTILES = (50, 95, 99)
+
+# Fixed-size ring buffer of one resolution
+# Each slot holds the average, minimum and maximum of the samples received during its period,
+# so min/max stay exact at every resolution. The slot being filled is updated in place on every sample,
+# so queries always include the latest values.
+class RingSeries:
+    def __init__(self, step, slots, columns=len(COLUMNS)):
+        self.step = step
+        self.slots = slots
+        # Start time of each slot, NaN while the slot has never been written
+        self.times = np.full(slots, np.nan)
+        self.avg = np.zeros((slots, columns), dtype=np.float32)
+        self.min = np.zeros((slots, columns), dtype=np.float32)
+        self.max = np.zeros((slots, columns), dtype=np.float32)
+        # Running aggregates of the current slot
+        self.slot = None
+        self.sums = np.zeros(columns)
+        self.count = 0
+
+    @property
+    def span(self):
+        """Returns the time covered by the buffer in seconds"""
+        return self.step * self.slots
+
+    def add(self, timestamp, values):
+        """Adds a sample (one value per column)"""
+        slot = int(timestamp // self.step)
+        position = slot % self.slots
+        if slot != self.slot:
+            # A new period starts, it overwrites the oldest slot
+            self.slot = slot
+            self.times[position] = slot * self.step
+            self.sums[:] = values
+            self.count = 1
+            self.min[position] = values
+            self.max[position] = values
+        else:
+            self.sums += values
+            self.count += 1
+            np.minimum(self.min[position], values, out=self.min[position])
+            np.maximum(self.max[position], values, out=self.max[position])
+        self.avg[position] = self.sums / self.count
+
+    def window(self, seconds, now):
+        """Returns the mask of the slots overlapping the last `seconds`"""
+        # NaN compares as False, so the empty slots are excluded
+        with np.errstate(invalid='ignore'):
+            return self.times > now - seconds - self.step
+
+    def ordered(self, seconds, now):
+        """Returns (times, averages) of the slots of the window, oldest first"""
+        mask = self.window(seconds, now)
+        order = np.argsort(self.times[mask])
+        return self.times[mask][order], self.avg[mask][order]
+
+# History of the sampled metrics at several resolutions
+# Fed by the sampler thread, read by the GUI, the HTTP endpoint and the smoothing of the frames.
+class MetricsHistory:
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = resolutions
+        self.series = [RingSeries(step, slots) for _, step, slots in resolutions]
+        self._lock = threading.Lock()
+
+    def add(self, timestamp, cpu, mem):
+        """Records a sample at every resolution"""
+        values = np.array((cpu, mem))
+        with self._lock:
+            for series in self.series:
+                series.add(timestamp, values)
+
+    def series_for(self, seconds):
+        """Returns the finest resolution covering a window (the coarsest one for longer windows)"""
+        for series in self.series:
+            if series.span >= seconds:
+                return series
+        return self.series[-1]
+
+    def stats(self, seconds, now=None):
+        """Returns {column: {'min', 'max', 'avg', 'p50', 'p95', 'p99', 'samples'}} over the last `seconds`,
+        or None if there is no sample in the window"""
+        now = time.time() if now is None else now
+        series = self.series_for(seconds)
+        with self._lock:
+            mask = series.window(seconds, now)
+            if not mask.any():
+                return None
+            averages = series.avg[mask]
+            minimums = series.min[mask].min(axis=0)
+            maximums = series.max[mask].max(axis=0)
+            means = averages.mean(axis=0)
+            percentiles = np.percentile(averages, PERCENTILES, axis=0)
+        stats = {}
+        for index, column in enumerate(COLUMNS):
+            column_stats = {
+                'min': float(minimums[index]),
+                'max': float(maximums[index]),
+                'avg': float(means[index]),
+                'samples': int(mask.sum()),
+            }
+            for percentile, values in zip(PERCENTILES, percentiles):
+                column_stats[f'p{percentile}'] = float(values[index])
+            stats[column] = column_stats
+        return stats
+
+    def smoothed(self, seconds, now=None):
+        """Returns the average (cpu, mem) of the last `seconds`, None if there is no sample in the window"""
+        now = time.time() if now is None else now
+        series = self.series_for(seconds)
+        with self._lock:
+            mask = series.window(seconds, now)
+            if not mask.any():
+                return None
+            means = series.avg[mask].mean(axis=0)
+        return float(means[0]), float(means[1])
+
+    def history(self, seconds, now=None):
+        """Returns (times, values) of the last `seconds` at the finest resolution covering them, oldest first;
+        values has one column per metric"""
+        now = time.time() if now is None else now
+        series = self.series_for(seconds)
+        with self._lock:
+            return series.ordered(seconds, now)
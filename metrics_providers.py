@@ -0,0 +1,339 @@
+import os
+import sys
+import subprocess
+import threading
+import psutil
+
+from power import WHEEL
+
+# Seconds between two scans of the process table by the top-process providers
+TOP_SCAN_INTERVAL = 2.0
+# Seconds between two runs of the command of a script provider
+SCRIPT_INTERVAL = 0.5
+
+# Metrics providers for the data packet
+# Each provider returns one value in percent (0-100); the packet carries two of them,
+# shown by the keyboard in the CPU and memory slots.
+class MetricsProvider:
+    name = None
+    # Optional text sent with the value to the keyboards supporting it (e.g. the name of the top process)
+    label = None
+
+    def read(self):
+        """Returns the current value in percent"""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the resources held by the provider"""
+        pass
+
+# CPU usage through psutil, measured since the previous call (non-blocking)
+class PsutilCpuProvider(MetricsProvider):
+    name = 'psutil-cpu'
+
+    def __init__(self):
+        # Prime psutil so the first call has a reference point
+        psutil.cpu_percent(interval=None)
+
+    def read(self):
+        return psutil.cpu_percent(interval=None)
+
+# Memory usage through psutil
+class PsutilMemoryProvider(MetricsProvider):
+    name = 'psutil-mem'
+
+    def read(self):
+        return psutil.virtual_memory().percent
+
+# Usage of the busiest core, useful for single-threaded workloads
+class MaxCoreCpuProvider(MetricsProvider):
+    name = 'cpu-max'
+
+    def __init__(self):
+        psutil.cpu_percent(interval=None, percpu=True)
+
+    def read(self):
+        return max(psutil.cpu_percent(interval=None, percpu=True))
+
+# 1-minute load average relative to the number of CPUs
+class LoadAverageProvider(MetricsProvider):
+    name = 'load'
+
+    def __init__(self):
+        self.cpu_count = os.cpu_count() or 1
+
+    def read(self):
+        return min(100.0, os.getloadavg()[0] / self.cpu_count * 100.0)
+
+# Swap usage
+class SwapProvider(MetricsProvider):
+    name = 'swap'
+
+    def read(self):
+        return psutil.swap_memory().percent
+
+# Base class for the Linux providers reading a /proc or /sys file
+# The file stays open and is re-read from offset 0 with preadv into a preallocated buffer,
+# so a sample costs one syscall and no file object.
+class CachedFileReader(MetricsProvider):
+    buffer_size = 512
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(self.buffer_size)
+
+    def read_file(self):
+        """Reads the beginning of the file into the buffer and returns the number of bytes read"""
+        return os.preadv(self.fd, [self.buffer], 0)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# CPU usage from /proc/stat, computed like psutil (idle and iowait count as not busy)
+class ProcStatCpuProvider(CachedFileReader):
+    name = 'proc-cpu'
+
+    def __init__(self, path='/proc/stat'):
+        super().__init__(path)
+        self.last_total, self.last_idle = self.read_times()
+
+    def read_times(self):
+        """Returns the total and idle jiffies from the aggregated 'cpu' line"""
+        size = self.read_file()
+        end = self.buffer.find(b'\n', 0, size)
+        # user nice system idle iowait irq softirq steal (guest times are already part of user/nice)
+        fields = self.buffer[:end].split()
+        user, nice, system, idle, iowait, irq, softirq, steal = map(int, fields[1:9])
+        total = user + nice + system + idle + iowait + irq + softirq + steal
+        return total, idle + iowait
+
+    def read(self):
+        total, idle = self.read_times()
+        delta_total = total - self.last_total
+        delta_idle = idle - self.last_idle
+        self.last_total, self.last_idle = total, idle
+        if delta_total <= 0:
+            return 0.0
+        return max(0.0, min(100.0, (delta_total - delta_idle) * 100.0 / delta_total))
+
+# Memory usage from /proc/meminfo, computed like psutil ((total - available) / total)
+class ProcMeminfoProvider(CachedFileReader):
+    name = 'proc-mem'
+
+    def __init__(self, path='/proc/meminfo'):
+        super().__init__(path)
+
+    def read(self):
+        size = self.read_file()
+        total = available = None
+        start = 0
+        # MemTotal and MemAvailable are among the first lines, stop as soon as both are found
+        while start < size and (total is None or available is None):
+            end = self.buffer.find(b'\n', start, size)
+            if end < 0:
+                end = size
+            if self.buffer.startswith(b'MemTotal:', start):
+                total = int(self.buffer[start + 9:end].split()[0])
+            elif self.buffer.startswith(b'MemAvailable:', start):
+                available = int(self.buffer[start + 13:end].split()[0])
+            start = end + 1
+        if not total or available is None:
+            raise ValueError("MemTotal/MemAvailable not found in /proc/meminfo")
+        return (total - available) * 100.0 / total
+
+# Temperature from a sysfs thermal zone, in degrees Celsius (shown as percent, clamped to 0-100)
+class SysfsTemperatureProvider(CachedFileReader):
+    name = 'temp'
+    buffer_size = 32
+
+    def __init__(self, path='/sys/class/thermal/thermal_zone0/temp'):
+        super().__init__(path)
+
+    def read(self):
+        size = self.read_file()
+        # The value is in millidegrees
+        return max(0.0, min(100.0, int(self.buffer[:size]) / 1000.0))
+
+# Value printed by a user command (a single number, in percent)
+# The command runs on a background timer of the wheel (its worker thread, like the process scan) and read() only
+# returns the last result, so a slow command never delays the sampling. The value is 0 until the first run.
+class ScriptProvider(MetricsProvider):
+    name = 'script'
+
+    def __init__(self, command, timeout=1.0, interval=SCRIPT_INTERVAL):
+        self.command = command
+        self.timeout = timeout
+        self.value = 0.0
+        # Error of the last run, reported by read() until the command succeeds again
+        self.error = None
+        self.timer = WHEEL.schedule(self.run, interval, name='script', background=True)
+
+    def run(self):
+        """Runs the command and keeps the value it printed (timer callback)"""
+        try:
+            output = subprocess.run(self.command, shell=True, capture_output=True, text=True,
+                                    timeout=self.timeout, check=True).stdout
+            self.value = max(0.0, min(100.0, float(output.strip())))
+            self.error = None
+        except (subprocess.SubprocessError, OSError, ValueError) as e:
+            self.error = f"{self.command}: {e}"
+
+    def read(self):
+        if self.error is not None:
+            raise ValueError(self.error)
+        return self.value
+
+    def close(self):
+        if self.timer is not None:
+            WHEEL.cancel(self.timer)
+            self.timer = None
+
+# Background scan of the process table for the process using the most CPU
+# The psutil.Process objects are kept between scans (pid -> Process), so each scan only creates the new ones
+# and cpu_percent() measures since the previous scan. The scan is a background timer of the wheel (run by its
+# worker thread, not the sampling one) at TOP_SCAN_INTERVAL, slower still while the server is idle so the map
+# stays primed; the providers only read its last result, so a long scan never delays the sampling.
+class ProcessScanner:
+    _lock = threading.Lock()
+    _shared = None
+    _users = 0
+
+    @classmethod
+    def acquire(cls):
+        """Returns the scanner shared by the providers, started by the first one"""
+        with cls._lock:
+            if cls._shared is None:
+                cls._shared = cls()
+                cls._shared.start()
+            cls._users += 1
+            return cls._shared
+
+    @classmethod
+    def release(cls):
+        """Stops the shared scanner when its last provider is closed"""
+        with cls._lock:
+            cls._users -= 1
+            if cls._users == 0 and cls._shared is not None:
+                cls._shared.stop()
+                cls._shared = None
+
+    def __init__(self, interval=TOP_SCAN_INTERVAL):
+        self.interval = interval
+        self.processes = {}
+        self.cpu_count = psutil.cpu_count() or 1
+        self.total_memory = psutil.virtual_memory().total
+        # (name, CPU in percent of the machine, RSS in percent of the memory) of the top process
+        self.top = ('', 0.0, 0.0)
+        self.timer = None
+
+    def start(self):
+        """Starts scanning on the timer wheel (the first scan runs at the next tick, so the startup is not delayed)"""
+        self.timer = WHEEL.schedule(self.scan, self.interval, name='process-scan', background=True)
+
+    def scan(self):
+        """Updates the process map and finds the process with the highest CPU usage since the previous scan"""
+        pids = set(psutil.pids())
+        for pid in self.processes.keys() - pids:
+            del self.processes[pid]
+        for pid in pids - self.processes.keys():
+            try:
+                process = psutil.Process(pid)
+                # The first call only sets the reference point of cpu_percent()
+                process.cpu_percent(None)
+                self.processes[pid] = process
+            except psutil.Error:
+                pass
+
+        top_process, top_cpu, gone = None, -1.0, []
+        for pid, process in self.processes.items():
+            try:
+                cpu = process.cpu_percent(None)
+            except psutil.Error:
+                gone.append(pid)
+                continue
+            if cpu > top_cpu:
+                top_process, top_cpu = process, cpu
+        for pid in gone:
+            del self.processes[pid]
+        if top_process is None:
+            return
+        try:
+            # One read of the process status for both values
+            with top_process.oneshot():
+                name = top_process.name()
+                rss = top_process.memory_info().rss
+        except psutil.Error:
+            return
+        self.top = (name, top_cpu / self.cpu_count, rss * 100.0 / self.total_memory)
+
+    def stop(self):
+        """Stops scanning, waiting for a scan in progress"""
+        if self.timer is not None:
+            WHEEL.cancel(self.timer)
+            self.timer = None
+
+# CPU usage of the busiest process (in percent of the machine), its name is the label
+class TopProcessCpuProvider(MetricsProvider):
+    name = 'top-cpu'
+
+    def __init__(self):
+        self.scanner = ProcessScanner.acquire()
+
+    @property
+    def label(self):
+        return self.scanner.top[0]
+
+    def read(self):
+        return self.scanner.top[1]
+
+    def close(self):
+        if self.scanner is not None:
+            self.scanner = None
+            ProcessScanner.release()
+
+# Resident memory of the busiest process (in percent of the machine), its name is the label
+class TopProcessMemoryProvider(TopProcessCpuProvider):
+    name = 'top-mem'
+
+    def read(self):
+        return self.scanner.top[2]
+
+PROVIDERS = {provider.name: provider for provider in (
+    PsutilCpuProvider, PsutilMemoryProvider, MaxCoreCpuProvider, LoadAverageProvider, SwapProvider,
+    ProcStatCpuProvider, ProcMeminfoProvider, SysfsTemperatureProvider, ScriptProvider, TopProcessCpuProvider,
+    TopProcessMemoryProvider,
+)}
+
+def has_proc():
+    """Tells if the fast /proc providers can be used"""
+    return sys.platform.startswith('linux') and os.access('/proc/stat', os.R_OK) and os.access('/proc/meminfo', os.R_OK)
+
+def create_provider(spec):
+    """Creates a provider from 'name' or 'name:argument' (e.g. 'temp:/sys/class/thermal/thermal_zone1/temp')"""
+    name, _, argument = spec.partition(':')
+    # 'cpu' and 'mem' pick the fast /proc readers on Linux, psutil elsewhere
+    if name in ('cpu', 'mem'):
+        name = ('proc-' if has_proc() else 'psutil-') + name
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown metrics provider: {name}")
+    provider_class = PROVIDERS[name]
+    return provider_class(argument) if argument else provider_class()
+
+def create_providers(specs):
+    """Creates the two providers of the packet from a 'first,second' string"""
+    parts = [spec.strip() for spec in specs.split(',')]
+    if len(parts) != 2:
+        raise ValueError("Two metrics providers are needed, e.g. 'cpu,mem'")
+    providers = []
+    try:
+        for spec in parts:
+            providers.append(create_provider(spec))
+    except Exception:
+        # The providers already built may hold a timer or the shared process scanner
+        for provider in providers:
+            provider.close()
+        raise
+    return providers
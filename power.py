@@ -0,0 +1,373 @@
+import ctypes
+import ctypes.util
+import glob
+import math
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+# Resolution of the timer wheel in seconds: the periods are rounded to it, and timers due in the same tick
+# run in one wakeup
+TICK = 0.05
+# Period of the timers while idle (no keyboard connected or screen locked)
+IDLE_INTERVAL = 5.0
+# Frame period while the screen is locked, kept well under the default stall timeout of the keyboards
+LOCKED_FRAME_INTERVAL = 2.0
+# Seconds between two checks of the screen lock
+LOCK_CHECK_INTERVAL = 5.0
+
+def round_period(period):
+    """Returns a period rounded to the wheel resolution"""
+    return max(TICK, round(period / TICK) * TICK)
+
+def aligned_delay(period, now=None):
+    """Returns the time until the next multiple of period on the monotonic clock
+    Loops waiting with it wake up together when they share a period (or their periods share multiples),
+    instead of each at its own phase."""
+    period = round_period(period)
+    now = time.monotonic() if now is None else now
+    return period - now % period
+
+# Periodic callback of the timer wheel
+class Timer:
+    __slots__ = ('callback', 'period', 'idle_period', 'name', 'background', 'slot', 'runs')
+
+    def __init__(self, callback, period, idle_period, name, background=False):
+        self.callback = callback
+        self.period = period
+        # Period while idle, None to suspend the timer
+        self.idle_period = idle_period
+        self.name = name
+        # Run by the worker thread of the wheel instead of the wheel thread itself
+        self.background = background
+        # Tick number of the next run, None while suspended or cancelled
+        self.slot = None
+        self.runs = 0
+
+# Central scheduler of the periodic work
+# Timers are kept in slots keyed by tick number (a hashed timer wheel), and their runs are aligned on
+# multiples of their period, so work with the same or related periods shares one wakeup. The thread sleeps
+# until the next occupied slot, never on a fixed tick. While idle the timers switch to their idle period
+# (or are suspended), which brings the wakeup rate close to zero.
+# The slow timers (process scan, file and system checks) are background timers: the wheel thread only hands
+# them to its worker thread, so they never delay the frame sampling.
+class TimerWheel:
+    def __init__(self):
+        lock = threading.RLock()
+        # Wakes the wheel thread, the worker thread, and the threads waiting for a callback to return
+        self._condition = threading.Condition(lock)
+        self._work = threading.Condition(lock)
+        self._done = threading.Condition(lock)
+        self.slots = {}
+        self.timers = []
+        self.idle_reasons = set()
+        self.wakeups = 0
+        self.started_at = time.monotonic()
+        # {timer: thread running its callback}
+        self.running = {}
+        # (timer, slot) of the background timers due, in order
+        self.pending = deque()
+        self.thread = None
+        self.worker = None
+
+    @property
+    def idle(self):
+        """Tells if the server is idle (no keyboard connected or screen locked)"""
+        return bool(self.idle_reasons)
+
+    def schedule(self, callback, period, idle_period=IDLE_INTERVAL, name=None, background=False):
+        """Runs callback() every period seconds (idle_period while idle, None = suspended) and returns the Timer
+        The callback can return a period for its next run only (e.g. a faster rate after a spike). A background
+        timer runs on the worker thread, for callbacks that may block (I/O, child processes, long scans)."""
+        timer = Timer(callback, period, idle_period, name or getattr(callback, '__qualname__', 'timer'), background)
+        with self._condition:
+            self.timers.append(timer)
+            self._place(timer, time.monotonic())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='timer-wheel')
+                self.thread.daemon = True
+                self.thread.start()
+            if background and self.worker is None:
+                self.worker = threading.Thread(target=self.run_worker, name='timer-worker')
+                self.worker.daemon = True
+                self.worker.start()
+            self._condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        """Removes a timer, waiting for its callback to return if it is running in another thread"""
+        with self._condition:
+            if timer in self.timers:
+                self.timers.remove(timer)
+            self._unplace(timer)
+            while self.running.get(timer, threading.current_thread()) is not threading.current_thread():
+                self._done.wait()
+
+    def reschedule(self, timer, period):
+        """Changes the period of a timer, applied from now"""
+        with self._condition:
+            timer.period = period
+            if timer in self.timers:
+                self._unplace(timer)
+                self._place(timer, time.monotonic())
+                self._condition.notify()
+
+    def set_idle(self, reason, active):
+        """Adds or removes a reason to be idle ('no-clients', 'locked'); the timers switch period accordingly"""
+        with self._condition:
+            was_idle = self.idle
+            if active:
+                self.idle_reasons.add(reason)
+            else:
+                self.idle_reasons.discard(reason)
+            if self.idle != was_idle:
+                now = time.monotonic()
+                for timer in self.timers:
+                    self._unplace(timer)
+                    self._place(timer, now)
+                self._condition.notify()
+
+    def _period(self, timer):
+        return timer.idle_period if self.idle else timer.period
+
+    def _place(self, timer, now, period=None):
+        period = period or self._period(timer)
+        if period is None:
+            return
+        # Ceiling, so a timer never runs before its deadline (minus the float noise of exact multiples)
+        timer.slot = math.ceil((now + aligned_delay(period, now)) / TICK - 1e-6)
+        self.slots.setdefault(timer.slot, []).append(timer)
+
+    def _unplace(self, timer):
+        if timer.slot is None:
+            return
+        timers = self.slots.get(timer.slot)
+        if timers is not None and timer in timers:
+            timers.remove(timer)
+            if not timers:
+                del self.slots[timer.slot]
+        timer.slot = None
+
+    def _run_timer(self, timer, slot):
+        """Runs the callback of a timer (called with the lock held, released meanwhile) and places its next run"""
+        self.running[timer] = threading.current_thread()
+        self._condition.release()
+        try:
+            next_period = timer.callback()
+        except Exception as e:
+            next_period = None
+            print(f"Error in the timer {timer.name}: {e}")
+        finally:
+            self._condition.acquire()
+            del self.running[timer]
+            self._done.notify_all()
+        timer.runs += 1
+        # The timer may have been cancelled or rescheduled by its callback; the next run is
+        # counted from its slot, so an early wakeup cannot run it twice
+        if timer in self.timers and timer.slot is None:
+            self._place(timer, max(time.monotonic(), slot * TICK), next_period if not self.idle else None)
+            self._condition.notify()
+
+    def run(self):
+        """Main loop: sleeps until the next occupied slot, runs its timers and hands the background ones over"""
+        with self._condition:
+            while True:
+                timeout = None
+                if self.slots:
+                    timeout = max(0.0, min(self.slots) * TICK - time.monotonic())
+                self._condition.wait(timeout)
+                self.wakeups += 1
+                # A wait may return a little early
+                current_slot = int(time.monotonic() / TICK + 1e-3)
+                for slot in sorted(slot for slot in self.slots if slot <= current_slot):
+                    # A callback may have cancelled the only timer of a later slot, removing the slot
+                    for timer in self.slots.pop(slot, ()):
+                        # Cancelled or rescheduled while an earlier timer of the slot was running
+                        if timer.slot != slot:
+                            continue
+                        timer.slot = None
+                        if timer.background:
+                            self.pending.append((timer, slot))
+                            self._work.notify()
+                        else:
+                            self._run_timer(timer, slot)
+
+    def run_worker(self):
+        """Worker loop: runs the background timers handed over by the wheel thread, one at a time"""
+        with self._condition:
+            while True:
+                while not self.pending:
+                    self._work.wait()
+                timer, slot = self.pending.popleft()
+                # Cancelled while waiting for its turn
+                if timer in self.timers:
+                    self._run_timer(timer, slot)
+
+    def diagnostics(self, seconds=2.0):
+        """Measures the wakeups per second over `seconds`: of the wheel, and of the whole process when the OS
+        tells (context switches of every thread, Linux only)"""
+        seconds = max(0.1, min(seconds, 30.0))
+        wheel_before, process_before = self.wakeups, process_context_switches()
+        time.sleep(seconds)
+        wheel_after, process_after = self.wakeups, process_context_switches()
+        with self._condition:
+            timers = [{'name': timer.name, 'period': timer.period, 'idle_period': timer.idle_period,
+                       'active_period': self._period(timer), 'background': timer.background, 'runs': timer.runs}
+                      for timer in self.timers]
+        return {
+            'idle': self.idle,
+            'idle_reasons': sorted(self.idle_reasons),
+            'seconds': seconds,
+            'wheel_wakeups_per_second': (wheel_after - wheel_before) / seconds,
+            'process_wakeups_per_second': (process_after - process_before) / seconds
+                                          if process_before is not None and process_after is not None else None,
+            'threads': threading.active_count(),
+            'timers': timers,
+        }
+
+# Timer wheel shared by the whole process (server, sampler, GUI)
+WHEEL = TimerWheel()
+
+def process_context_switches():
+    """Returns the total context switches of the threads of this process (Linux), None elsewhere
+    Every wakeup of a sleeping thread is one voluntary switch, so the rate approximates the wakeups."""
+    total = 0
+    paths = glob.glob('/proc/self/task/*/status')
+    if not paths:
+        return None
+    for path in paths:
+        try:
+            with open(path, 'rb') as status:
+                for line in status:
+                    if line.startswith((b'voluntary_ctxt_switches', b'nonvoluntary_ctxt_switches')):
+                        total += int(line.split()[1])
+        except (OSError, ValueError):
+            # The thread ended between the listing and the read
+            pass
+    return total
+
+# sd_bus_error of libsystemd
+class SdBusError(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_char_p), ('message', ctypes.c_char_p), ('_need_free', ctypes.c_int)]
+
+# Session of systemd-logind, read over the system bus with libsystemd (sd-bus)
+# The connection is opened once, so a check is one D-Bus call instead of a loginctl process.
+class LogindSession:
+    def __init__(self, session):
+        library = ctypes.util.find_library('systemd')
+        if library is None:
+            raise OSError("libsystemd not found")
+        self.library = ctypes.CDLL(library)
+        self.library.sd_bus_open_system.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+        self.library.sd_bus_path_encode.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p)]
+        self.library.sd_bus_get_property_trivial.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p,
+                                                             ctypes.c_char_p, ctypes.c_char_p,
+                                                             ctypes.POINTER(SdBusError), ctypes.c_char, ctypes.c_void_p]
+        self.library.sd_bus_error_free.argtypes = [ctypes.POINTER(SdBusError)]
+        self.library.sd_bus_unref.argtypes = [ctypes.c_void_p]
+        self.library.sd_bus_unref.restype = ctypes.c_void_p
+
+        # Object path of the session, e.g. /org/freedesktop/login1/session/_32 for session 2
+        path = ctypes.c_void_p()
+        self.check(self.library.sd_bus_path_encode(b'/org/freedesktop/login1/session', session.encode(),
+                                                   ctypes.byref(path)))
+        self.path = ctypes.string_at(path)
+        ctypes.CDLL(None).free(path)
+        self.bus = ctypes.c_void_p()
+        self.check(self.library.sd_bus_open_system(ctypes.byref(self.bus)))
+
+    @staticmethod
+    def check(result):
+        """Raises OSError if a libsystemd call failed (negative errno)"""
+        if result < 0:
+            raise OSError(-result, os.strerror(-result))
+
+    def locked(self):
+        """Returns the LockedHint of the session, raises OSError if it cannot be read"""
+        error = SdBusError()
+        value = ctypes.c_int()
+        try:
+            self.check(self.library.sd_bus_get_property_trivial(
+                self.bus, b'org.freedesktop.login1', self.path, b'org.freedesktop.login1.Session', b'LockedHint',
+                ctypes.byref(error), b'b', ctypes.byref(value)))
+        finally:
+            self.library.sd_bus_error_free(ctypes.byref(error))
+        return bool(value.value)
+
+    def close(self):
+        """Closes the bus connection"""
+        self.library.sd_bus_unref(self.bus)
+        self.bus = ctypes.c_void_p()
+
+# LogindSession of the current session, False when sd-bus cannot be used (loginctl is run instead)
+_logind = None
+_loginctl = None
+
+def screen_locked():
+    """Tells if the session screen is locked (Windows, and Linux sessions managed by systemd-logind)
+    Not thread-safe on Linux: called by the timer of the ScreenLockMonitor only."""
+    global _logind, _loginctl
+    if sys.platform == 'win32':
+        user32 = ctypes.windll.user32
+        # The input desktop cannot be switched to while the lock screen is shown
+        desktop = user32.OpenInputDesktop(0, False, 0x0100)
+        if not desktop:
+            return True
+        try:
+            return not user32.SwitchDesktop(desktop)
+        finally:
+            user32.CloseDesktop(desktop)
+    session = os.environ.get('XDG_SESSION_ID')
+    if not session:
+        return False
+    if _logind is None:
+        try:
+            _logind = LogindSession(session)
+        except (OSError, AttributeError):
+            _logind = False
+    if _logind:
+        try:
+            return _logind.locked()
+        except OSError:
+            # Reconnect on the next check (e.g. the bus was restarted)
+            _logind.close()
+            _logind = None
+            return False
+    if _loginctl is None:
+        _loginctl = shutil.which('loginctl') or ''
+    if not _loginctl:
+        return False
+    try:
+        output = subprocess.run([_loginctl, 'show-session', session, '-p', 'LockedHint', '--value'],
+                                capture_output=True, text=True, timeout=2).stdout
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return output.strip() == 'yes'
+
+# Marks the wheel idle while the screen is locked, checked by a timer that keeps running while idle
+class ScreenLockMonitor:
+    def __init__(self, wheel=WHEEL, interval=LOCK_CHECK_INTERVAL):
+        self.wheel = wheel
+        self.interval = interval
+        self.timer = None
+
+    def check(self):
+        """Updates the 'locked' idle reason"""
+        self.wheel.set_idle('locked', screen_locked())
+
+    def start(self):
+        """Starts checking the screen lock"""
+        if self.timer is None:
+            self.timer = self.wheel.schedule(self.check, self.interval, idle_period=self.interval,
+                                             name='screen-lock', background=True)
+
+    def stop(self):
+        """Stops checking, the screen is then considered unlocked"""
+        if self.timer is not None:
+            self.wheel.cancel(self.timer)
+            self.timer = None
+        self.wheel.set_idle('locked', False)
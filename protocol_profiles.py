@@ -0,0 +1,125 @@
+import json
+import operator
+import struct
+
+# Conversions from a metric in percent (0-100) to the value packed in the frame
+UNITS = {
+    'fraction': lambda value: value / 100.0,
+    'percent': float,
+    'byte': lambda value: max(0, min(100, int(value + 0.5))),
+}
+
+# Fields a frame can carry: the two metrics, and the label of the providers (e.g. the name of the top process),
+# packed as UTF-8 in an 's' field (struct truncates or pads it to the field size)
+FIELDS = ('cpu', 'mem', 'label')
+
+# A keyboard sending a handshake starts with this line, e.g. b'HELLO gk104-pro\n'
+HELLO_PREFIX = b'HELLO '
+HELLO_MAX_SIZE = 64
+
+def encode_label(label, size):
+    """Returns the bytes of a label for an 's' field of `size` bytes, cut at a character boundary"""
+    encoded = (label or '').encode('utf-8', 'replace')
+    if len(encoded) > size:
+        # struct would cut the bytes, possibly in the middle of a multi-byte character
+        encoded = encoded[:size].decode('utf-8', 'ignore').encode('utf-8')
+    return encoded
+
+# Protocol of a keyboard model: frame layout, update rate and ACK semantics
+# The frame struct and the packing functions are built once here, so packing a frame
+# does not parse any format. values(snapshot) returns the frame values, pack_into(buffer, snapshot)
+# packs them at the start of buffer.
+class ProtocolProfile:
+    __slots__ = ('name', 'frame', 'fields', 'units', 'values', 'pack_into', 'interval', 'ack_size', 'ack_timeout')
+
+    def __init__(self, name, format='<ff', fields=('cpu', 'mem'), units='fraction', interval=None, ack_size=1,
+                 ack_timeout=None):
+        if isinstance(fields, str):
+            fields = tuple(field.strip() for field in fields.split(','))
+        if not 1 <= len(fields) <= 3:
+            raise ValueError(f"Profile {name} must have one to three fields")
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError(f"Unknown field in profile {name}: {field}")
+        if units not in UNITS:
+            raise ValueError(f"Unknown units in profile {name}: {units}")
+        self.name = name
+        self.frame = struct.Struct(format)
+        # The struct must take exactly one value per field
+        if len(self.frame.unpack(bytes(self.frame.size))) != len(fields):
+            raise ValueError(f"The format of profile {name} does not match its fields")
+        self.fields = tuple(fields)
+        self.units = units
+        # values(snapshot) and pack_into(buffer, snapshot) are closures over the getters and the conversion
+        convert = UNITS[units]
+        pack_into = self.frame.pack_into
+        if 'label' in fields:
+            label_field = self.frame.unpack(bytes(self.frame.size))[fields.index('label')]
+            if not isinstance(label_field, bytes):
+                raise ValueError(f"The label of profile {name} must be an 's' field")
+            label_size = len(label_field)
+            # Rare and variable: one converter per field
+            converters = [(operator.attrgetter(field),
+                           (lambda label: encode_label(label, label_size)) if field == 'label' else convert)
+                          for field in fields]
+            self.values = lambda snapshot: tuple(conversion(getter(snapshot)) for getter, conversion in converters)
+            self.pack_into = lambda buffer, snapshot: pack_into(buffer, 0, *self.values(snapshot))
+        elif len(fields) == 1:
+            first = operator.attrgetter(fields[0])
+            self.values = lambda snapshot: (convert(first(snapshot)),)
+            self.pack_into = lambda buffer, snapshot: pack_into(buffer, 0, convert(first(snapshot)))
+        else:
+            first, second = (operator.attrgetter(field) for field in fields)
+            self.values = lambda snapshot: (convert(first(snapshot)), convert(second(snapshot)))
+            self.pack_into = lambda buffer, snapshot: pack_into(buffer, 0, convert(first(snapshot)),
+                                                                convert(second(snapshot)))
+        # Frame period and ACK wait in seconds (None = the server defaults)
+        self.interval = interval
+        # Size of the ACK answering each frame, 0 if the keyboard does not acknowledge
+        self.ack_size = ack_size
+        self.ack_timeout = ack_timeout
+
+    def pack(self, snapshot):
+        """Returns the frame of a snapshot"""
+        return self.frame.pack(*self.values(snapshot))
+
+DEFAULT_PROFILE = 'gk104-pro'
+
+# Built-in profiles
+PROFILES = {profile.name: profile for profile in (
+    # Skyloong GK104 Pro: CPU and memory as little-endian floats (0-1), one ACK byte per frame
+    ProtocolProfile('gk104-pro'),
+    # Two bytes in whole percent, no ACK, one frame per second (for simple DIY firmwares)
+    ProtocolProfile('compact', format='<BB', units='byte', interval=1.0, ack_size=0),
+    # gk104-pro followed by the 16-byte name of the top process (with the top-cpu,top-mem metrics)
+    ProtocolProfile('top-process', format='<ff16s', fields=('cpu', 'mem', 'label')),
+)}
+
+def load_profiles(path):
+    """Reads extra profiles from a JSON file: {"name": {"format": "<ff", "fields": "cpu,mem", "units": "fraction",
+    "interval": 0.3, "ack_size": 1, "ack_timeout": 1.0}, ...} and returns them with the built-in ones"""
+    with open(path, 'r', encoding='utf-8') as profiles_file:
+        definitions = json.load(profiles_file)
+    profiles = dict(PROFILES)
+    for name, options in definitions.items():
+        try:
+            profiles[name] = ProtocolProfile(name, **options)
+        except (TypeError, struct.error) as e:
+            raise ValueError(f"Invalid profile {name}: {e}")
+    return profiles
+
+def parse_client_profiles(specs, profiles):
+    """Parses 'IP=profile' specs into {ip: profile}"""
+    client_profiles = {}
+    for spec in specs or ():
+        address, _, name = spec.partition('=')
+        if not address or name not in profiles:
+            raise ValueError(f"Invalid client profile: {spec}")
+        client_profiles[address.strip()] = profiles[name]
+    return client_profiles
+
+def parse_hello(data):
+    """Returns the profile name of a handshake line, None if data is not one"""
+    if not data.startswith(HELLO_PREFIX):
+        return None
+    return data[len(HELLO_PREFIX):].split(b'\n', 1)[0].strip().decode('ascii', 'replace')
@@ -0,0 +1,172 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+from metrics_providers import MetricsProvider
+from power import WHEEL
+
+# A recording is an 8-byte header followed by 16-byte '<dff' records, only ever appended to:
+# frame records are (wall time, CPU %, memory %), ACK records are (wall time, ACK_MARK, ACK latency in seconds)
+MAGIC = b'SKYREC1\n'
+RECORD = struct.Struct('<dff')
+ACK_MARK = -1.0
+# Seconds between two flushes of the recorder, so a crash loses at most this much
+RECORD_FLUSH_INTERVAL = 1.0
+
+# Appends the frames sent to the keyboards and their ACK timings to a recording
+# Called by every client loop, so the writes are serialized; the timestamp is taken under the lock,
+# which keeps the file in time order.
+class FrameRecorder:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        elif self.file.tell() < len(MAGIC) or (self.file.tell() - len(MAGIC)) % RECORD.size:
+            # An interrupted write left a partial record: pad it so the next ones stay aligned
+            self.file.write(bytes(RECORD.size - (self.file.tell() - len(MAGIC)) % RECORD.size))
+        self.records = 0
+        self.timer = WHEEL.schedule(self.flush, RECORD_FLUSH_INTERVAL, name='recorder', background=True)
+
+    def frame(self, snapshot):
+        """Records a frame sent to a keyboard"""
+        with self._lock:
+            if self.file is not None:
+                self.file.write(RECORD.pack(time.time(), snapshot.cpu, snapshot.mem))
+                self.records += 1
+
+    def ack(self, latency):
+        """Records the ACK of a frame and its latency in seconds"""
+        with self._lock:
+            if self.file is not None:
+                self.file.write(RECORD.pack(time.time(), ACK_MARK, latency))
+                self.records += 1
+
+    def flush(self):
+        """Writes the buffered records to the file (timer callback)"""
+        with self._lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        """Flushes and closes the recording"""
+        WHEEL.cancel(self.timer)
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# Timestamps of a recording as a sequence, read from the mapped file without copying (for bisect)
+class RecordTimes:
+    def __init__(self, recording):
+        self.recording = recording
+
+    def __len__(self):
+        return len(self.recording)
+
+    def __getitem__(self, index):
+        return self.recording.record(index)[0]
+
+# Read-only view of a recording through mmap
+# The records are read in place with unpack_from, so opening a long recording costs no memory.
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as recording_file:
+            if recording_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a recording")
+            size = os.fstat(recording_file.fileno()).st_size
+            self.count = (size - len(MAGIC)) // RECORD.size
+            # An empty recording cannot be mapped, nothing to read anyway
+            self.map = mmap.mmap(recording_file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+        self.times = RecordTimes(self)
+        self.first_frame = self.find_frame(0, 1)
+        self.last_frame = self.find_frame(self.count - 1, -1)
+        if self.first_frame is None:
+            raise ValueError(f"{path} contains no frame")
+
+    def __len__(self):
+        return self.count
+
+    def record(self, index):
+        """Returns the (timestamp, value, value) of a record"""
+        return RECORD.unpack_from(self.map, len(MAGIC) + index * RECORD.size)
+
+    def find_frame(self, index, step):
+        """Returns the index of the first frame record from index in the direction of step, None if there is none"""
+        while 0 <= index < self.count:
+            if self.record(index)[1] != ACK_MARK:
+                return index
+            index += step
+        return None
+
+    @property
+    def duration(self):
+        """Returns the time between the first and the last frame"""
+        return self.record(self.last_frame)[0] - self.record(self.first_frame)[0]
+
+    def values_at(self, timestamp):
+        """Returns the (cpu, mem) of the last frame sent at or before timestamp"""
+        index = self.find_frame(bisect.bisect_right(self.times, timestamp) - 1, -1)
+        if index is None:
+            index = self.first_frame
+        _, cpu, mem = self.record(index)
+        return cpu, mem
+
+    def ack_latencies(self):
+        """Yields the recorded ACK latencies in order"""
+        for index in range(self.count):
+            _, mark, latency = self.record(index)
+            if mark == ACK_MARK:
+                yield latency
+
+    def close(self):
+        """Unmaps the file"""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+# Clock of a replay: maps the current time to a time of the recording, `speed` times faster than real time,
+# looping at the end
+class ReplayClock:
+    def __init__(self, recording, speed=1.0):
+        if speed <= 0:
+            raise ValueError("The replay speed must be positive")
+        self.recording = recording
+        self.speed = speed
+        self.start = self.recording.record(recording.first_frame)[0]
+        self.started_at = None
+
+    def now(self):
+        """Returns the current time of the recording (the replay starts at the first call)"""
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        elapsed = (time.monotonic() - self.started_at) * self.speed
+        duration = self.recording.duration
+        if duration > 0:
+            elapsed %= duration
+        return self.start + elapsed
+
+# Value of a recording at the replay time, as the sampler would have read it
+class ReplayProvider(MetricsProvider):
+    name = 'replay'
+
+    def __init__(self, clock, column):
+        self.clock = clock
+        self.column = column
+
+    def read(self):
+        return self.clock.recording.values_at(self.clock.now())[self.column]
+
+    def close(self):
+        # Both providers share the recording, the first close unmaps it
+        self.clock.recording.close()
+
+def create_replay_providers(path, speed=1.0):
+    """Creates the CPU and memory providers replaying a recording at `speed` times real time"""
+    clock = ReplayClock(Recording(path), speed)
+    return [ReplayProvider(clock, 0), ReplayProvider(clock, 1)]
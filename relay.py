@@ -0,0 +1,269 @@
+import heapq
+import selectors
+import socket
+import threading
+import time
+
+from metrics_providers import MetricsProvider
+from power import aligned_delay
+from protocol_profiles import PROFILES, DEFAULT_PROFILE
+
+# The upstream servers are read like a keyboard would: 8-byte '<ff' frames, each answered by a 1-byte ACK
+UPSTREAM_FRAME = PROFILES[DEFAULT_PROFILE].frame
+UPSTREAM_ACK = b'\x01'
+# A node without frames for this long leaves the aggregate and is reconnected
+UPSTREAM_STALE_TIMEOUT = 5.0
+# Reconnection delay after a failure, doubled up to the maximum
+UPSTREAM_RETRY_MIN = 1.0
+UPSTREAM_RETRY_MAX = 30.0
+
+COLUMNS = ('cpu', 'mem')
+AGGREGATES = ('max', 'min', 'avg')
+
+# Incremental aggregate of the values of the upstream nodes
+# The average keeps running sums; max and min use heaps with lazy deletion (an entry is stale when its
+# node got a newer value), so an update costs O(log n) and a query is amortized O(1) whatever the number of nodes.
+class NodeAggregator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {node: (version, (cpu, mem))}
+        self.values = {}
+        self.sums = [0.0] * len(COLUMNS)
+        # Per column: heap of (-value, version, node) for max and (value, version, node) for min
+        self.max_heaps = [[] for _ in COLUMNS]
+        self.min_heaps = [[] for _ in COLUMNS]
+        self.version = 0
+
+    def update(self, node, values):
+        """Records the latest (cpu, mem) of a node"""
+        with self._lock:
+            self.version += 1
+            previous = self.values.get(node)
+            for index, value in enumerate(values):
+                self.sums[index] += value - (previous[1][index] if previous is not None else 0.0)
+                heapq.heappush(self.max_heaps[index], (-value, self.version, node))
+                heapq.heappush(self.min_heaps[index], (value, self.version, node))
+            self.values[node] = (self.version, values)
+            # Rebuild the heaps when the stale entries outnumber the live ones
+            if len(self.max_heaps[0]) > 4 * len(self.values) + 64:
+                self._rebuild()
+
+    def remove(self, node):
+        """Removes a node from the aggregate (its heap entries become stale)"""
+        with self._lock:
+            previous = self.values.pop(node, None)
+            if previous is not None:
+                for index, value in enumerate(previous[1]):
+                    self.sums[index] -= value
+
+    def _rebuild(self):
+        for index in range(len(COLUMNS)):
+            self.max_heaps[index] = [(-values[index], version, node) for node, (version, values) in self.values.items()]
+            self.min_heaps[index] = [(values[index], version, node) for node, (version, values) in self.values.items()]
+            heapq.heapify(self.max_heaps[index])
+            heapq.heapify(self.min_heaps[index])
+
+    def _top(self, heap):
+        # Drop the entries of removed nodes and the outdated values
+        while heap:
+            _, version, node = heap[0]
+            current = self.values.get(node)
+            if current is not None and current[0] == version:
+                return heap[0][0]
+            heapq.heappop(heap)
+        return None
+
+    def value(self, column, aggregate):
+        """Returns the aggregate ('max', 'min', 'avg') of a column, 0 if no node is connected"""
+        index = COLUMNS.index(column)
+        with self._lock:
+            if not self.values:
+                return 0.0
+            if aggregate == 'avg':
+                return self.sums[index] / len(self.values)
+            if aggregate == 'max':
+                return -self._top(self.max_heaps[index])
+            return self._top(self.min_heaps[index])
+
+    def node_value(self, node, column):
+        """Returns the value of one node, 0 if it is not connected"""
+        with self._lock:
+            current = self.values.get(node)
+        return current[1][COLUMNS.index(column)] if current is not None else 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+# Connection to one upstream server
+class UpstreamConnection:
+    __slots__ = ('node', 'address', 'socket', 'connecting', 'buffer', 'view', 'filled', 'last_frame', 'retry_at',
+                 'retry_delay')
+
+    def __init__(self, node, address):
+        self.node = node
+        self.address = address
+        self.socket = None
+        self.connecting = False
+        # The frame being received, possibly in several pieces
+        self.buffer = bytearray(UPSTREAM_FRAME.size)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        self.last_frame = 0.0
+        self.retry_at = 0.0
+        self.retry_delay = UPSTREAM_RETRY_MIN
+
+# Pool of upstream connections, one socket per node, all served by one selector thread
+# Every keyboard of the relay is fed from this pool, so a node is read once whatever the number of keyboards.
+class UpstreamPool:
+    def __init__(self, nodes, stale_timeout=UPSTREAM_STALE_TIMEOUT):
+        self.connections = {}
+        for node in nodes:
+            host, _, port = node.rpartition(':')
+            if not host or not port.isdigit():
+                raise ValueError(f"Invalid upstream address: {node} (expected HOST:PORT)")
+            self.connections[node] = UpstreamConnection(node, (host.strip('[]'), int(port)))
+        self.stale_timeout = stale_timeout
+        self.aggregator = NodeAggregator()
+        self.log = print
+        self.selector = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Starts the connection thread"""
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Main loop: connects the nodes, reads their frames and drops the stale ones"""
+        try:
+            while self.running:
+                now = time.monotonic()
+                for connection in self.connections.values():
+                    if connection.socket is None and now >= connection.retry_at:
+                        self.connect(connection)
+                # Frames wake the loop; otherwise once a second, on the shared grid, for retries and stale nodes
+                for key, events in self.selector.select(aligned_delay(1.0)):
+                    connection = key.data
+                    if connection.connecting:
+                        self.finish_connect(connection)
+                    else:
+                        self.read_frame(connection)
+                now = time.monotonic()
+                for connection in self.connections.values():
+                    # Also covers the connections that never complete
+                    if connection.socket is not None and now - connection.last_frame > self.stale_timeout:
+                        self.disconnect(connection, f"no frame for {self.stale_timeout}s")
+        finally:
+            for connection in self.connections.values():
+                if connection.socket is not None:
+                    self.disconnect(connection, None)
+            self.selector.close()
+
+    def connect(self, connection):
+        """Starts a non-blocking connection to a node"""
+        try:
+            connection.socket = socket.socket(
+                socket.AF_INET6 if ':' in connection.address[0] else socket.AF_INET, socket.SOCK_STREAM)
+            connection.socket.setblocking(False)
+            connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection.socket.connect_ex(connection.address)
+        except OSError as e:
+            self.disconnect(connection, e)
+            return
+        connection.connecting = True
+        connection.last_frame = time.monotonic()
+        self.selector.register(connection.socket, selectors.EVENT_WRITE, connection)
+
+    def finish_connect(self, connection):
+        """Completes a connection once its socket is writable"""
+        error = connection.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.disconnect(connection, OSError(error, "connection failed"))
+            return
+        connection.connecting = False
+        connection.filled = 0
+        connection.retry_delay = UPSTREAM_RETRY_MIN
+        self.selector.modify(connection.socket, selectors.EVENT_READ, connection)
+        self.log(f"Upstream {connection.node} connected")
+
+    def read_frame(self, connection):
+        """Reads the rest of the current frame, and records it once complete"""
+        try:
+            received = connection.socket.recv_into(connection.view[connection.filled:])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.disconnect(connection, e)
+            return
+        if not received:
+            self.disconnect(connection, "closed by the node")
+            return
+        connection.filled += received
+        if connection.filled < UPSTREAM_FRAME.size:
+            return
+
+        connection.filled = 0
+        connection.last_frame = time.monotonic()
+        cpu, mem = UPSTREAM_FRAME.unpack(connection.buffer)
+        self.aggregator.update(connection.node, (cpu * 100.0, mem * 100.0))
+        try:
+            connection.socket.send(UPSTREAM_ACK)
+        except (BlockingIOError, InterruptedError):
+            # The node resends after its ACK timeout
+            pass
+        except OSError as e:
+            self.disconnect(connection, e)
+
+    def disconnect(self, connection, reason):
+        """Closes the connection to a node, removes it from the aggregate and schedules a reconnection"""
+        if connection.socket is not None:
+            try:
+                self.selector.unregister(connection.socket)
+            except (KeyError, ValueError):
+                pass
+            connection.socket.close()
+            connection.socket = None
+        was_connected = not connection.connecting and connection.node in self.aggregator.values
+        connection.connecting = False
+        self.aggregator.remove(connection.node)
+        if reason is None:
+            return
+        connection.retry_at = time.monotonic() + connection.retry_delay
+        connection.retry_delay = min(connection.retry_delay * 2, UPSTREAM_RETRY_MAX)
+        if was_connected:
+            self.log(f"Upstream {connection.node} disconnected: {reason}")
+
+    def stop(self):
+        """Stops the connection thread and closes every connection"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+# Value of the relay: an aggregate of the nodes ('max', 'min', 'avg') or the value of one node ('HOST:PORT')
+class RelayProvider(MetricsProvider):
+    name = 'relay'
+
+    def __init__(self, pool, column, source):
+        if source not in AGGREGATES and source not in pool.connections:
+            raise ValueError(f"Unknown relay source: {source} (expected {', '.join(AGGREGATES)} or an upstream)")
+        self.aggregator = pool.aggregator
+        self.column = column
+        self.source = source
+
+    def read(self):
+        if self.source in AGGREGATES:
+            return self.aggregator.value(self.column, self.source)
+        return self.aggregator.node_value(self.source, self.column)
+
+def create_relay_providers(pool, sources):
+    """Creates the CPU and memory providers of a relay from 'source' or 'cpu source,mem source' (e.g. 'max,avg')"""
+    parts = [source.strip() for source in sources.split(',')]
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2:
+        raise ValueError("One or two relay sources are needed, e.g. 'max' or 'max,avg'")
+    return [RelayProvider(pool, column, source) for column, source in zip(COLUMNS, parts)]
@@ -0,0 +1,124 @@
+import threading
+from PIL import Image, ImageDraw
+
+from power import WHEEL
+
+# Size of the charts in pixels, and pixels scrolled per sample (2 px at 2 Hz: 85 seconds on screen)
+CHART_WIDTH = 340
+CHART_HEIGHT = 40
+CHART_STEP = 2
+# Charts are updated at this period, in seconds
+CHART_INTERVAL = 0.5
+# Top of the latency chart in seconds, slower ACKs are drawn at the top
+LATENCY_CHART_MAX = 0.05
+
+CHART_BACKGROUND = (32, 32, 32)
+CHART_GRID = (56, 56, 56)
+CPU_COLOR = (90, 170, 255)
+MEM_COLOR = (120, 220, 120)
+# Colors of the clients in the latency chart
+CLIENT_COLORS = ((255, 170, 60), (230, 90, 90), (200, 120, 255), (90, 220, 220), (240, 240, 100), (255, 140, 200))
+
+# Scrolling line chart drawn incrementally into a Pillow image
+# Each sample scrolls the image left by `step` pixels (one crop and paste, done in C) and draws only
+# the new segment of every series, so the cost does not depend on the length of the history.
+class Sparkline:
+    def __init__(self, width=CHART_WIDTH, height=CHART_HEIGHT, maximum=100.0, step=CHART_STEP):
+        self.width = width
+        self.height = height
+        self.maximum = maximum
+        self.step = step
+        self.image = Image.new('RGB', (width, height), CHART_BACKGROUND)
+        self.draw = ImageDraw.Draw(self.image)
+        # Last y of each series, the next segment starts there
+        self.last = {}
+        self.draw_grid(0, width)
+
+    def draw_grid(self, left, right):
+        """Draws the horizontal grid lines (25/50/75%) between two x"""
+        for fraction in (0.25, 0.5, 0.75):
+            y = self.height - 1 - int(fraction * (self.height - 1))
+            self.draw.line((left, y, right, y), fill=CHART_GRID)
+
+    def scroll(self):
+        """Scrolls the chart by one sample, leaving an empty strip on the right"""
+        strip = self.width - self.step
+        self.image.paste(self.image.crop((self.step, 0, self.width, self.height)), (0, 0))
+        self.draw.rectangle((strip, 0, self.width - 1, self.height - 1), fill=CHART_BACKGROUND)
+        self.draw_grid(strip, self.width - 1)
+
+    def plot(self, key, value, color):
+        """Draws the new segment of a series (call after scroll)"""
+        value = max(0.0, min(self.maximum, value))
+        y = self.height - 1 - int(value / self.maximum * (self.height - 1))
+        x = self.width - 1
+        self.draw.line((x - self.step, self.last.get(key, y), x, y), fill=color)
+        self.last[key] = y
+
+    def forget(self, key):
+        """Ends a series, its next value starts a new line"""
+        self.last.pop(key, None)
+
+# Timer of the shared timer wheel drawing the system and latency charts
+# The Tk thread only takes the latest images with take() and pastes them into its PhotoImages,
+# once per GUI frame.
+class ChartRenderer:
+    def __init__(self, get_values, get_latencies, interval=CHART_INTERVAL):
+        # get_values() returns (cpu, mem) in percent, get_latencies() returns {client: ACK latency in seconds}
+        self.get_values = get_values
+        self.get_latencies = get_latencies
+        self.interval = interval
+        self.system = Sparkline()
+        self.latency = Sparkline(maximum=LATENCY_CHART_MAX)
+        self.client_colors = {}
+        self._lock = threading.Lock()
+        self._images = None
+        self.timer = None
+
+    def start(self):
+        """Starts drawing on the timer wheel (at its idle period while the server is idle)"""
+        if self.timer is None:
+            self.timer = WHEEL.schedule(self.tick, self.interval, name='charts', background=True)
+
+    def tick(self):
+        """Draws one sample (timer callback)"""
+        try:
+            self.render()
+        except Exception as e:
+            print(f"Error while drawing the charts: {e}")
+
+    def render(self):
+        """Draws one sample on every chart and publishes copies of the images"""
+        cpu, mem = self.get_values()
+        self.system.scroll()
+        self.system.plot('cpu', cpu, CPU_COLOR)
+        self.system.plot('mem', mem, MEM_COLOR)
+
+        latencies = self.get_latencies()
+        self.latency.scroll()
+        for client, latency in latencies.items():
+            color = self.client_colors.get(client)
+            if color is None:
+                color = CLIENT_COLORS[len(self.client_colors) % len(CLIENT_COLORS)]
+                self.client_colors[client] = color
+            self.latency.plot(client, latency, color)
+        # Disconnected clients end their line
+        for client in [client for client in self.client_colors if client not in latencies]:
+            self.latency.forget(client)
+            del self.client_colors[client]
+
+        images = (self.system.image.copy(), self.latency.image.copy())
+        with self._lock:
+            self._images = images
+
+    def take(self):
+        """Returns the (system, latency) images drawn since the last call, or None"""
+        with self._lock:
+            images, self._images = self._images, None
+        return images
+
+    def stop(self):
+        """Stops drawing, waiting for a chart in progress"""
+        if self.timer is not None:
+            WHEEL.cancel(self.timer)
+            self.timer = None
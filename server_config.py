@@ -0,0 +1,152 @@
+import os
+
+from power import WHEEL
+
+# Settings of the configuration file and their type
+# The names are those of the 'serve' options, with '_' instead of '-' (e.g. max-clients-per-ip: 4 works too)
+SETTINGS = {
+    'host': str,
+    'port': int,
+    'listen': list,
+    'workers': int,
+    'engine': str,
+    'debug': bool,
+    'log_file': str,
+    'metrics': str,
+    'sample_interval': float,
+    'tick_interval': float,
+    'ack_timeout': float,
+    'stall_timeout': float,
+    'adaptive': bool,
+    'resolution': float,
+    'keepalive': float,
+    'metrics_port': int,
+    'metrics_host': str,
+    'max_clients': int,
+    'max_clients_per_ip': int,
+    'backlog': int,
+    'tcp_nodelay': bool,
+    'history': bool,
+    'smooth': float,
+    'profile': str,
+    'profiles_file': str,
+    'client_profile': list,
+    'handshake_timeout': float,
+    'upstream': list,
+    'aggregate': str,
+    'record': str,
+    'replay': str,
+    'replay_speed': float,
+}
+
+# Settings applied to a running server without dropping the keyboards, the others need a restart
+LIVE_SETTINGS = {
+    'debug', 'metrics', 'sample_interval', 'tick_interval', 'ack_timeout', 'stall_timeout', 'adaptive', 'resolution',
+    'keepalive', 'max_clients', 'max_clients_per_ip', 'tcp_nodelay', 'smooth', 'profile', 'client_profile',
+    'handshake_timeout',
+}
+
+# Seconds between two checks of the file modification time
+CONFIG_POLL_INTERVAL = 1.0
+
+def check_setting(name, value):
+    """Returns a setting converted to its type, raises ValueError if it has the wrong type"""
+    kind = SETTINGS[name]
+    if value is None:
+        return None
+    if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if kind is list and isinstance(value, dict):
+        # client-profile can also be written as a mapping {ip: profile}
+        return [f"{address}={profile}" for address, profile in value.items()]
+    if kind is list and isinstance(value, str):
+        # upstream and listen: host1:1648,host2:1648
+        return [value]
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise ValueError(f"{name} must be of type {kind.__name__}, not {type(value).__name__}")
+    return value
+
+def load_config(path):
+    """Reads a YAML (or .toml) configuration file and returns {setting: value}"""
+    with open(path, 'rb') as config_file:
+        content = config_file.read()
+    # The parsers are imported only when a file is used (PyYAML alone takes about 35 ms to import)
+    # A missing parser is reported like an invalid file (tomllib needs Python 3.11, yaml needs PyYAML)
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError(f"Unable to read {path}: TOML files need Python 3.11 or later")
+        parse, errors = lambda text: tomllib.loads(text.decode('utf-8')), (tomllib.TOMLDecodeError, UnicodeDecodeError)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError(f"Unable to read {path}: YAML files need PyYAML (pip install pyyaml)")
+        parse, errors = yaml.safe_load, yaml.YAMLError
+    try:
+        data = parse(content)
+    except errors as e:
+        raise ValueError(f"Unable to parse {path}: {e}")
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} must contain a mapping of settings")
+
+    config = {}
+    for key, value in data.items():
+        name = str(key).replace('-', '_')
+        if name not in SETTINGS:
+            raise ValueError(f"Unknown setting in {path}: {key}")
+        config[name] = check_setting(name, value)
+    return config
+
+# Watches the configuration file and calls on_change(config) with the new settings when it is modified
+# The modification time and size are polled by a timer of the shared timer wheel, which works on every platform
+# and with editors replacing the file.
+class ConfigWatcher:
+    def __init__(self, path, on_change, on_error=None, interval=CONFIG_POLL_INTERVAL):
+        self.path = path
+        self.on_change = on_change
+        self.on_error = on_error
+        self.interval = interval
+        self.signature = self.stat()
+        self.timer = None
+
+    def stat(self):
+        """Returns (modification time, size) of the file, None if it does not exist"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        """Starts watching"""
+        if self.timer is None:
+            self.timer = WHEEL.schedule(self.check, self.interval, name='config', background=True)
+
+    def check(self):
+        """Reloads the file if it changed (timer callback)"""
+        signature = self.stat()
+        if signature == self.signature or signature is None:
+            return
+        self.signature = signature
+        try:
+            config = load_config(self.path)
+        except (OSError, ValueError) as e:
+            # Keep the current settings until the file is fixed
+            if self.on_error:
+                self.on_error(e)
+            return
+        try:
+            self.on_change(config)
+        except Exception as e:
+            if self.on_error:
+                self.on_error(e)
+
+    def stop(self):
+        """Stops watching"""
+        if self.timer is not None:
+            WHEEL.cancel(self.timer)
+            self.timer = None
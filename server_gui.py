@@ -1,15 +1,19 @@
-import socket
-import struct
-import time
+from startup_profile import STARTUP
 import threading
-import psutil
+import queue
+from collections import deque
 import tkinter as tk
 from tkinter import ttk, messagebox
 import sys
+STARTUP.mark('tkinter imported')
 from PIL import Image, ImageTk, ImageDraw
-import pystray
-import io
 import os
+STARTUP.mark('Pillow imported')
+from keyboard_server import KeyboardDataServer, MetricsSampler, AdaptiveRate
+from metrics_providers import create_providers
+from server_charts import ChartRenderer, CHART_WIDTH, CHART_HEIGHT, LATENCY_CHART_MAX
+from power import IDLE_INTERVAL, aligned_delay
+STARTUP.mark('GUI modules imported')
 
 def resource_path(relative_path):
     try:
@@ -19,240 +23,156 @@ def resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
-# Server class for the Keyboard Data Server
-# This class handles the server operations, including starting, stopping, and managing client connections.
-class KeyboardDataServer:
-    def __init__(self, host='0.0.0.0', port=1648, debug=False):
-        self.host = host
-        self.port = port
-        self.server_socket = None
-        self.clients = []
-        self.running = False
-        self.debug = debug
-        self.server_thread = None
-        self.on_log = None
-        self.on_connection_change = None
-        self.on_status_change = None
-        self.on_system_stats = None
-        
-    def log(self, message, always_show=False):
-        """Prints the message only if in debug mode or if always_show is True"""
-        if self.debug or always_show:
-            print(message)
-            if self.on_log:
-                self.on_log(message)
-            
-    def start(self):
-        """Starts the server and listens for connections"""
-        if self.running:
-            return False
-            
-        try:
-            # Create the server socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            # Listen for incoming connections (max 5)
-            self.server_socket.listen(5)
-            self.running = True
-            
-            self.log(f"Server stared on {self.host}:{self.port}", always_show=True)
-            
-            if self.on_status_change:
-                self.on_status_change(True)
-                
-            # Start the server thread
-            self.server_thread = threading.Thread(target=self.run_server)
-            self.server_thread.daemon = True
-            self.server_thread.start()
-            
-            return True
-                
-        except Exception as e:
-            self.log(f"Error during the starting of the server: {e}", always_show=True)
-            if self.server_socket:
-                self.server_socket.close()
-            return False
-    
-    def run_server(self):
-        """Main loop of the server"""
-        accept_thread = threading.Thread(target=self.accept_connections)
-        accept_thread.daemon = True
-        accept_thread.start()
-        
-        # Update system stats periodically
-        while self.running:
-            # Send system stats to the GUI
-            if self.on_system_stats:
-                # Get CPU and memory usage
-                cpu = self.get_cpu_percent()
-                mem = self.get_memory_percent()
-                self.on_system_stats(cpu, mem)
-            # Sleep for a while before the next update
-            time.sleep(0.5)
-            
-    def accept_connections(self):
-        """Accept incoming client connections"""
-        while self.running:
-            try:
-                # Set a timeout for the accept call
-                self.server_socket.settimeout(1) 
-                try:
-                    # Accept a new client connection
-                    client_socket, client_address = self.server_socket.accept()
-                    self.log(f"New connection from {client_address}", always_show=True)
-                    
-                    # Start a new thread to handle the client
-                    client_thread = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_socket, client_address)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                    # Add the client to the list (not used, will be removed)
-                    self.clients.append((client_socket, client_address))
-                    
-                    # Notify the GUI about the new connection
-                    if self.on_connection_change:
-                        self.on_connection_change(len(self.clients))
-                
-                # If no connection is accepted within the timeout, continue
-                except socket.timeout:
-                    continue
-                    
-            except Exception as e:
-                # If the server is still running, log the error
-                if self.running:
-                    self.log(f"Error in accepting the connection: {e}")
-    
-    def handle_client(self, client_socket, client_address):
-        """Handles communication with a connected client"""
-        try:
-            while self.running:
-                # Generate the 8-byte data packet with real CPU and memory information (as in the original app)
-                data = self.get_system_data_packet()
-                
-                # Send the data to the client
-                client_socket.send(data)
-                
-                # Log the sent data (detailed only in debug mode)
-                cpu_percent = self.get_cpu_percent()
-                mem_percent = self.get_memory_percent()
-                self.log(f"Data sent to: {client_address}: CPU: {cpu_percent}%, Memory: {mem_percent}%")
-                
-                # Wait for the client's response (ACK - 1 byte) (as in the original app)
-                try:
-                    client_socket.settimeout(1)
-                    response = client_socket.recv(1)
-                    if not response:
-                        self.log(f"Client {client_address} disconnected", always_show=True)
-                        break
-                    
-                    self.log(f"Ricevuto da {client_address}: {response.hex()}")
-                except socket.timeout:
-                    # If the client does not respond within the timeout, log the error
-                    if not self.running:
-                        break
-                    continue
-                
-                time.sleep(0.3)
-                
-        except Exception as e:
-            self.log(f"Error with the client {client_address}: {e}")
-        finally:
-            # Close the client socket and remove it from the list
-            try:
-                client_socket.close()
-                if (client_socket, client_address) in self.clients:
-                    self.clients.remove((client_socket, client_address))
-                    
-                    # Notify the GUI about the disconnection
-                    if self.on_connection_change:
-                        self.on_connection_change(len(self.clients))
-            except:
-                pass
-            self.log(f"Connection with {client_address} closed", always_show=True)
-    
-    def get_cpu_percent(self):
-        """Obtains the CPU usage percentage"""
-        return psutil.cpu_percent(interval=0.1)
-    
-    def get_memory_percent(self):
-        """Obtains the memory usage percentage"""
-        return psutil.virtual_memory().percent
-    
-    def get_system_data_packet(self):
-        """Generates an 8-byte data packet with CPU and memory information"""
-        cpu_percent = self.get_cpu_percent() / 100.0
-        mem_percent = self.get_memory_percent() / 100.0 
-        
-        packet = struct.pack('<ff', cpu_percent, mem_percent)
-        return packet
-    
-    def stop(self):
-        """Stops the server and closes all connections"""
-        if not self.running:
-            return
-            
-        self.running = False
+_icon_image = None
 
-        # Close all client connections
-        for client_socket, _ in self.clients:
-            try:
-                client_socket.close()
-            except:
-                pass
-        self.clients = []
-        
-        # Close the server socket
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
-        
-        # Notify the GUI about the server status change
-        if self.on_status_change:
-            self.on_status_change(False)
-            
-        # Notify the GUI about the disconnection
-        if self.on_connection_change:
-            self.on_connection_change(0)
-            
-        self.log("Server stopped", always_show=True)
+def load_icon_image():
+    """Returns the application icon (RGBA), decoded once and shared by the window and the tray"""
+    global _icon_image
+    if _icon_image is not None:
+        return _icon_image
+    try:
+        # The first image of the ICO file
+        _icon_image = Image.open(resource_path("tastiera.ico")).convert('RGBA')
+    except Exception as e:
+        print(f"Impossible to load the icon: {e}")
+        # Fallback to a default icon (green circle on a transparent background)
+        width = 64
+        height = 64
+        _icon_image = Image.new('RGBA', (width, height), color=(0, 0, 0, 0))
+        draw = ImageDraw.Draw(_icon_image)
+        center = width // 2
+        radius = width // 3
+        draw.ellipse(
+            [(center - radius, center - radius),
+             (center + radius, center + radius)],
+            fill=(0, 180, 0, 255)
+        )
+    return _icon_image
+
+# GUI refresh period: server events are queued and applied to the widgets once per frame
+GUI_FRAME_MS = 100
+# Refresh period while the window is hidden in the tray (nothing is drawn, the queues are only drained)
+GUI_HIDDEN_FRAME_MS = int(IDLE_INTERVAL * 1000)
+# Maximum number of log lines waiting for the next frame, the extra lines are dropped
+LOG_QUEUE_SIZE = 1000
+# Default number of lines kept in the log pane, and how many lines are trimmed at once when it is full
+LOG_MAX_LINES = 500
+LOG_TRIM_BATCH = 50
+# Window of the statistics shown under the progress bars, in seconds
+STATS_WINDOW = 60
+# Target time from the process start to the first paint of the window, in milliseconds
+FIRST_PAINT_TARGET_MS = 500
 
 # GUI class for the Keyboard Data Server
 class ServerGUI:
-    def __init__(self, root, daemon_mode=False):
+    def __init__(self, root, daemon_mode=False, engine='threads', log_lines=LOG_MAX_LINES, log_file=None,
+                 metrics='cpu,mem', adaptive=None, metrics_port=None, smoothing=None, profile_startup=False):
         self.root = root
         self.root.title("Skyloong Display Server")
-        self.root.geometry("400x450")
-        self.root.minsize(400, 450)
+        self.root.geometry("400x560")
+        self.root.minsize(400, 560)
         
-        # Icon for the system tray
-        self.icon_data = self.create_icon_image()
-        self.icon_image = Image.open(io.BytesIO(self.icon_data))
+        # System tray icon, created after the first paint
         self.icon = None
         
         # Daemon mode flag
         self.daemon_mode = daemon_mode
+        self.profile_startup = profile_startup
+
+        # Server events arrive from worker threads: they are queued here and applied by the Tk thread.
+        # Stats, connection count and status are coalesced (only the latest value is kept),
+        # log lines go through a bounded queue and are inserted in one batch per frame.
+        self.log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.dropped_log_lines = 0
+        self.pending_lock = threading.Lock()
+        self.pending_stats = None
+        self.pending_connections = None
+        self.pending_status = None
+
+        # Ring buffer backing the log pane: the widget never holds more than about log_lines lines,
+        # and while the window is hidden only the buffer is updated
+        self.log_lines = deque(maxlen=log_lines)
+        self.log_widget_lines = 0
+        self.log_view_stale = False
+        self.window_hidden = False
+
+        # Set up after the first paint (see finish_startup)
+        self.history = None
+        self.sampler = None
+        self.server = None
+        self.charts = None
+        self.update_job = None
+        self.server_options = {'engine': engine, 'log_file': log_file, 'adaptive': adaptive,
+                               'metrics_port': metrics_port}
+        self.metrics = metrics
+        self.smoothing = smoothing
 
-        self.server = KeyboardDataServer()
-        self.server.on_log = self.update_log
-        self.server.on_connection_change = self.update_connection_status
-        self.server.on_status_change = self.update_server_status
-        self.server.on_system_stats = self.update_system_stats
-        
-        # Add keyboard shortcuts
-        self.root.bind("<Control-d>", self.toggle_daemon_mode)  # Ctrl+D for daemon mode
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
-        # Create layout
+        # Create layout, the controls are enabled once the server exists
         self.setup_ui()
-        
+        self.start_button.config(state=tk.DISABLED)
+        self.debug_check.config(state=tk.DISABLED)
+        STARTUP.mark('window built')
+
+        # Show the window first: the sampler (and its psutil warmup), the charts and the tray come next
+        self.root.after_idle(self.first_paint)
+
+    def first_paint(self):
+        """Draws the window, logs the time to first paint and schedules the rest of the startup"""
+        self.root.update_idletasks()
+        STARTUP.mark('first paint')
+        first_paint_ms = STARTUP.since_process_start()
+        self.update_log(f"First paint in {first_paint_ms:.0f} ms")
+        if first_paint_ms > FIRST_PAINT_TARGET_MS:
+            self.update_log(f"Warning: first paint above the {FIRST_PAINT_TARGET_MS} ms target")
+        # A short delay lets the window system show the frame before the Tk thread gets busy again
+        self.root.after(1, self.finish_startup)
+
+    def finish_startup(self):
+        """Creates the sampler, the server, the charts and the tray icon (after the first paint)"""
+        # Shared sampler, used by both the GUI and the server; it records every sample in the history.
+        # NumPy (behind the history) is loaded only here, it is the slowest import of the GUI
+        from metrics_history import MetricsHistory
+        self.history = MetricsHistory()
+        try:
+            providers = create_providers(self.metrics)
+        except (ValueError, OSError) as e:
+            # Raised inside a Tk callback the error would only be printed, keep the window usable with the defaults
+            self.update_log(f"Invalid metrics '{self.metrics}': {e}, using 'cpu,mem'")
+            messagebox.showerror("Error", f"Invalid metrics '{self.metrics}':\n{e}\n\nUsing 'cpu,mem' instead")
+            self.metrics = 'cpu,mem'
+            providers = create_providers(self.metrics)
+        self.sampler = MetricsSampler(interval=0.5, providers=providers, history=self.history,
+                                      smoothing=self.smoothing)
+        self.sampler.start()
+        STARTUP.mark('sampler started')
+
+        self.server = KeyboardDataServer(sampler=self.sampler, **self.server_options)
+        self.server.on_log = self.update_log
+        self.server.on_connection_change = self.queue_connection_status
+        self.server.on_status_change = self.queue_server_status
+        self.server.on_system_stats = self.queue_system_stats
+        self.start_button.config(state=tk.NORMAL)
+        self.debug_check.config(state=tk.NORMAL)
+
+        # Add keyboard shortcuts
+        self.root.bind("<Control-d>", self.toggle_daemon_mode)  # Ctrl+D for daemon mode
+
+        # The charts are drawn by the timer wheel, the Tk thread only swaps the images once per frame
+        self.charts = ChartRenderer(lambda: (self.sampler.snapshot.cpu, self.sampler.snapshot.mem),
+                                    self.get_client_latencies)
+        self.charts.start()
+        self.update_system_stats_periodically()
+
         # Configure the system tray
         self.setup_tray()
+        STARTUP.mark('tray created')
+
+        # Start applying the queued server events
+        self.update_job = self.root.after(GUI_FRAME_MS, self.process_queued_updates)
+        if self.profile_startup:
+            STARTUP.report()
         
         # If starting in daemon mode, start server and minimize
         if self.daemon_mode:
@@ -279,56 +199,16 @@ class ServerGUI:
             self.hide_window()
         return "break"  # Prevent the event from being processed further
     
-    def create_icon_image(self):
-        """Create the icon image for the system tray"""
-        try:
-            # Load the icon from the ICO file
-            icon_path = resource_path("tastiera.ico")
-            icon = Image.open(icon_path)
-            # Use the first image if the ICO contains multiple formats
-            if hasattr(icon, 'seek'):
-                icon.seek(0)
-                
-            # Convert to bytes
-            output = io.BytesIO()
-            icon.save(output, format='PNG')
-            output.seek(0)
-            return output.getvalue()
-            
-        except Exception as e:
-            print(f"Impossible to load the icon: {e}")
-            # Fallback to a default icon (green circle)
-            width = 64
-            height = 64
-            
-            # Create a new image with a transparent background
-            image = Image.new('RGBA', (width, height), color=(0,0,0,0))
-            draw = ImageDraw.Draw(image)
-            
-            # Draw a green circle
-            center = width // 2
-            radius = width // 3
-            draw.ellipse(
-                [(center - radius, center - radius), 
-                 (center + radius, center + radius)], 
-                fill=(0, 180, 0, 255)
-            )
-            
-            # Convert to bytes
-            output = io.BytesIO()
-            image.save(output, format='PNG')
-            output.seek(0)
-            
-            return output.getvalue()
-    
     def setup_tray(self):
+        # pystray loads its desktop backend when imported, so it is loaded only with the tray icon
+        import pystray
         menu = (
             pystray.MenuItem('Show', self.show_window),
             pystray.MenuItem('Start server', self.start_server),
             pystray.MenuItem('Stop server', self.stop_server),
             pystray.MenuItem('Exit', self.exit_application)
         )
-        self.icon = pystray.Icon("skyloong_monitor", self.icon_image, "Skyloong Monitor", menu)
+        self.icon = pystray.Icon("skyloong_monitor", load_icon_image(), "Skyloong Monitor", menu)
     
     def setup_ui(self):
         """Create the GUI layout"""
@@ -399,6 +279,19 @@ class ServerGUI:
         self.mem_label = ttk.Label(system_frame, text="0%")
         self.mem_label.grid(row=1, column=2, sticky=tk.W, padx=5, pady=2)
         
+        # Statistics of the last minute, from the history
+        self.history_label = ttk.Label(system_frame, text="")
+        self.history_label.grid(row=2, column=0, columnspan=3, sticky=tk.W, padx=5, pady=2)
+        
+        # CPU (blue) and memory (green) history, and ACK latency of each client (0-50 ms)
+        empty_chart = Image.new('RGB', (CHART_WIDTH, CHART_HEIGHT))
+        self.system_chart = ImageTk.PhotoImage(empty_chart)
+        ttk.Label(system_frame, image=self.system_chart).grid(row=3, column=0, columnspan=3, padx=5, pady=2)
+        ttk.Label(system_frame, text=f"ACK latency per keyboard (0-{LATENCY_CHART_MAX * 1000:.0f} ms):").grid(
+            row=4, column=0, columnspan=3, sticky=tk.W, padx=5, pady=2)
+        self.latency_chart = ImageTk.PhotoImage(empty_chart)
+        ttk.Label(system_frame, image=self.latency_chart).grid(row=5, column=0, columnspan=3, padx=5, pady=2)
+        
         # Frame for logs
         log_frame = ttk.LabelFrame(main_frame, text="Log", padding=10)
         log_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -411,28 +304,117 @@ class ServerGUI:
         log_scrollbar = ttk.Scrollbar(log_frame, command=self.log_text.yview)
         log_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.log_text.config(yscrollcommand=log_scrollbar.set)
-        
-        # Start updating system stats
-        self.update_system_stats_periodically()
     
     def update_system_stats_periodically(self):
         """Update system stats periodically"""
         if not hasattr(self, 'root') or not self.root:
             return
         
-        cpu = psutil.cpu_percent()
-        mem = psutil.virtual_memory().percent
-        self.update_system_stats(cpu, mem)
+        snapshot = self.sampler.snapshot
+        self.update_system_stats(snapshot.cpu, snapshot.mem)
         
-        # Update the system stats every 500ms
+        # Update the system stats at the sampling period, on the ticks of the timer wheel (slower while hidden)
         if not self.server.running:
-            self.root.after(500, self.update_system_stats_periodically)
+            interval = IDLE_INTERVAL if self.window_hidden else self.sampler.interval
+            self.root.after(int(aligned_delay(interval) * 1000), self.update_system_stats_periodically)
+    
+    def get_client_latencies(self):
+        """Returns the last ACK latency of each connected client (called by the chart thread)"""
+        return {client.address: client.ack_latency for client in self.server.clients.snapshot()
+                if client.ack_latency is not None}
     
     def update_log(self, message):
-        """Update the log text area with a new message"""
-        if self.debug_var.get() or message.startswith("Server "):
-            self.log_text.insert(tk.END, message + "\n")
-            self.log_text.see(tk.END)
+        """Queue a message for the log text area (safe from any thread, never blocks)"""
+        try:
+            self.log_queue.put_nowait(message)
+        except queue.Full:
+            self.dropped_log_lines += 1
+    
+    def queue_connection_status(self, num_connections):
+        """Queue the number of active connections, only the latest value is kept"""
+        with self.pending_lock:
+            self.pending_connections = num_connections
+    
+    def queue_server_status(self, is_running):
+        """Queue the server status, only the latest value is kept"""
+        with self.pending_lock:
+            self.pending_status = is_running
+    
+    def queue_system_stats(self, cpu, mem):
+        """Queue the CPU and memory usage, only the latest values are kept"""
+        with self.pending_lock:
+            self.pending_stats = (cpu, mem)
+    
+    def process_queued_updates(self):
+        """Apply the queued server events to the widgets, called by the Tk thread once per frame"""
+        # The window was shown again, rebuild the log pane from the ring buffer
+        if self.log_view_stale and not self.window_hidden:
+            self.render_log()
+        
+        with self.pending_lock:
+            stats, self.pending_stats = self.pending_stats, None
+            connections, self.pending_connections = self.pending_connections, None
+            status, self.pending_status = self.pending_status, None
+        
+        if status is not None:
+            self.update_server_status(status)
+        if connections is not None:
+            self.update_connection_status(connections)
+        if stats is not None:
+            self.update_system_stats(*stats)
+        
+        # Swap in the charts drawn since the last frame (nothing to show while hidden)
+        charts = self.charts.take()
+        if charts is not None and not self.window_hidden:
+            self.system_chart.paste(charts[0])
+            self.latency_chart.paste(charts[1])
+        
+        # Drain the log queue and insert all the lines at once
+        lines = []
+        try:
+            while True:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if self.dropped_log_lines:
+            lines.append(f"[{self.dropped_log_lines} log lines dropped]")
+            self.dropped_log_lines = 0
+        if lines:
+            self.flush_log(lines)
+        
+        self.update_job = self.root.after(GUI_HIDDEN_FRAME_MS if self.window_hidden else GUI_FRAME_MS,
+                                          self.process_queued_updates)
+    
+    def flush_log(self, lines):
+        """Insert a batch of messages in the log text area"""
+        show_all = self.debug_var.get()
+        shown = [line for line in lines if show_all or line.startswith("Server ")]
+        if not shown:
+            return
+        self.log_lines.extend(shown)
+        
+        # Nothing to draw while the window is hidden
+        if self.window_hidden:
+            self.log_view_stale = True
+            return
+        
+        self.log_text.insert(tk.END, "".join(line + "\n" for line in shown))
+        self.log_widget_lines += len(shown)
+        
+        # Trim the oldest lines in batches rather than one by one
+        excess = self.log_widget_lines - self.log_lines.maxlen
+        if excess >= LOG_TRIM_BATCH:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_widget_lines -= excess
+        self.log_text.see(tk.END)
+    
+    def render_log(self):
+        """Redraw the log text area from the ring buffer"""
+        self.log_text.delete("1.0", tk.END)
+        self.log_text.insert(tk.END, "".join(line + "\n" for line in self.log_lines))
+        self.log_widget_lines = len(self.log_lines)
+        self.log_view_stale = False
+        self.log_text.see(tk.END)
     
     def update_connection_status(self, num_connections):
         """Update the connection status label with the number of active connections"""
@@ -457,6 +439,11 @@ class ServerGUI:
         self.mem_var.set(mem)
         self.cpu_label.config(text=f"{cpu:.1f}%")
         self.mem_label.config(text=f"{mem:.1f}%")
+        stats = self.history.stats(STATS_WINDOW)
+        if stats is not None:
+            self.history_label.config(
+                text=f"Last minute: CPU avg {stats['cpu']['avg']:.1f}% max {stats['cpu']['max']:.1f}%, "
+                     f"memory avg {stats['mem']['avg']:.1f}% max {stats['mem']['max']:.1f}%")
     
     def start_server(self):
         """Start the server"""
@@ -529,7 +516,7 @@ class ServerGUI:
     
     def on_close(self):
         """Handle the window close event"""
-        if self.server.running:
+        if self.server is not None and self.server.running:
             response = messagebox.askyesnocancel("Exit", "The server is still running.\n"
                                                         "Do you want to stop the server and exit?\n\n"
                                                         "Yes = Stop and exit\n"
@@ -548,20 +535,31 @@ class ServerGUI:
     
     def hide_window(self):
         """Hide the main window and show the system tray icon"""
+        self.window_hidden = True
         self.root.withdraw()
         if self.icon is not None and not self.icon.visible:
             threading.Thread(target=self.icon.run, daemon=True).start()
     
     def show_window(self):
         """Show the main window"""
+        self.window_hidden = False
+        # Refresh right away instead of waiting for the slow hidden frame
+        if self.update_job is not None:
+            self.root.after_cancel(self.update_job)
+            self.update_job = self.root.after_idle(self.process_queued_updates)
         self.root.deiconify()
         self.root.lift()
         self.root.focus_force()
     
     def exit_application(self):
         """Exit the application"""
-        if self.server.running:
-            self.server.stop()
+        # Closed before the end of the startup, nothing was started yet
+        if self.server is not None:
+            if self.server.running:
+                self.server.stop()
+            self.charts.stop()
+            self.server.close()
+            self.sampler.close()
         
         if self.icon is not None and self.icon.visible:
             self.icon.stop()
@@ -569,33 +567,51 @@ class ServerGUI:
         self.root.quit()
         self.root.destroy()
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Entry point of the GUI application"""
     # Parse command line arguments
     import argparse
     parser = argparse.ArgumentParser(description="Skyloong Display Server")
     parser.add_argument("--daemon", action="store_true", help="Start server in daemon mode")
-    args = parser.parse_args()
+    parser.add_argument("--engine", choices=["threads", "asyncio", "broadcast"], default="threads",
+                        help="Connection engine: one thread per client, a single asyncio event loop, "
+                             "or one thread broadcasting the same frame to every client")
+    parser.add_argument("--log-lines", type=int, default=LOG_MAX_LINES, help="Number of lines kept in the log pane")
+    parser.add_argument("--log-file", help="Also write the log to this file, rotated every 1 MB")
+    parser.add_argument("--metrics", default="cpu,mem",
+                        help="The two values sent to the keyboard, e.g. 'cpu,mem' or 'cpu-max,swap'")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Send a frame only when a value changes by at least 1 point, faster after spikes")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics (/metrics) and the history (/history) on this port, localhost only")
+    parser.add_argument("--smooth", type=float, metavar="SECONDS",
+                        help="Send the average of the last SECONDS instead of the raw values")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print the import and initialization timeline once the GUI is ready")
+    args = parser.parse_args(argv)
     
     root = tk.Tk()
     try:
         # Set the icon for the main window
         try:
-            # Load the icon from the ICO file
-            icon_path = resource_path("tastiera.ico")
             if sys.platform == 'win32':
-                root.iconbitmap(icon_path)
+                root.iconbitmap(resource_path("tastiera.ico"))
             else:
-                icon = Image.open(icon_path)
-                if hasattr(icon, 'seek'):
-                    icon.seek(0)
-                photo = ImageTk.PhotoImage(icon)
+                # Same decoded image as the tray icon
+                photo = ImageTk.PhotoImage(load_icon_image())
                 root.iconphoto(True, photo)
         except Exception as e:
             print(f"Unable to load icon: {e}")
             
-        app = ServerGUI(root, daemon_mode=args.daemon)
+        app = ServerGUI(root, daemon_mode=args.daemon, engine=args.engine,
+                        log_lines=args.log_lines, log_file=args.log_file, metrics=args.metrics,
+                        adaptive=AdaptiveRate() if args.adaptive else None, metrics_port=args.metrics_port,
+                        smoothing=args.smooth, profile_startup=args.profile_startup)
         root.mainloop()
     except Exception as e:
         print(f"Fatal error: {e}")
         import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    main()
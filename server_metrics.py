@@ -0,0 +1,209 @@
+import bisect
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from power import WHEEL, IDLE_INTERVAL
+
+# Counters and histograms exported on /metrics, all prefixed with 'skyloong_'
+COUNTERS = {
+    'frames_sent_total': "Frames sent to the keyboards",
+    'acks_received_total': "ACKs received from the keyboards",
+    'ack_timeouts_total': "Frames not acknowledged within the ACK timeout",
+    'accept_errors_total': "Errors while accepting connections",
+    'connections_total': "Connections accepted",
+    'connections_rejected_total': "Connections closed because of the connection limits",
+}
+HISTOGRAMS = {
+    'ack_latency_seconds': ("Time from sending a frame to receiving its ACK",
+                            (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)),
+    'sampling_duration_seconds': ("Time spent reading the system metrics",
+                                  (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)),
+}
+
+# Counters of a single thread
+# Every key exists from the start, so the exporter can read a shard while its thread updates it.
+class MetricsShard:
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # [bucket counts (the last one is +Inf), sum, count]
+        self.histograms = {name: [[0] * (len(buckets) + 1), 0.0, 0] for name, (_, buckets) in HISTOGRAMS.items()}
+
+    def merge(self, other):
+        """Adds the values of another shard to this one"""
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for name, (buckets, total, count) in other.histograms.items():
+            histogram = self.histograms[name]
+            for index, bucket in enumerate(buckets):
+                histogram[0][index] += bucket
+            histogram[1] += total
+            histogram[2] += count
+
+# Server-side instrumentation
+# Each thread records into its own shard without any lock; the shards are only summed when exported.
+class ServerMetrics:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        # Shards of the threads that have exited, folded together
+        self._retired = MetricsShard()
+        # Taken only when a thread records for the first time and when exporting
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = MetricsShard(threading.current_thread())
+            self._local.shard = shard
+            with self._lock:
+                # Also fold here: without a scrape, one shard per connection thread would pile up
+                self._fold_exited()
+                self._shards.append(shard)
+        return shard
+
+    def _fold_exited(self):
+        """Folds the shards of the exited threads into the retired one, so their number stays bounded
+        Called with the lock held."""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = alive
+
+    def inc(self, name, value=1):
+        """Increments a counter"""
+        self._shard().counters[name] += value
+
+    def observe(self, name, value):
+        """Records a value in a histogram"""
+        histogram = self._shard().histograms[name]
+        histogram[0][bisect.bisect_left(HISTOGRAMS[name][1], value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def totals(self):
+        """Returns a shard with the sum of all the threads"""
+        total = MetricsShard()
+        with self._lock:
+            self._fold_exited()
+            total.merge(self._retired)
+            for shard in self._shards:
+                total.merge(shard)
+        return total
+
+    def render(self, clients):
+        """Returns the metrics in the Prometheus text format, clients is a ClientRegistry snapshot"""
+        total = self.totals()
+        lines = []
+        for name, help_text in COUNTERS.items():
+            lines.append(f"# HELP skyloong_{name} {help_text}")
+            lines.append(f"# TYPE skyloong_{name} counter")
+            lines.append(f"skyloong_{name} {total.counters[name]}")
+
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            counts, histogram_sum, histogram_count = total.histograms[name]
+            lines.append(f"# HELP skyloong_{name} {help_text}")
+            lines.append(f"# TYPE skyloong_{name} histogram")
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f'skyloong_{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'skyloong_{name}_bucket{{le="+Inf"}} {histogram_count}')
+            lines.append(f"skyloong_{name}_sum {histogram_sum}")
+            lines.append(f"skyloong_{name}_count {histogram_count}")
+
+        lines.append("# HELP skyloong_active_clients Connected keyboards")
+        lines.append("# TYPE skyloong_active_clients gauge")
+        lines.append(f"skyloong_active_clients {len(clients)}")
+
+        lines.append("# HELP skyloong_client_uptime_seconds Time since each keyboard connected")
+        lines.append("# TYPE skyloong_client_uptime_seconds gauge")
+        now = time.monotonic()
+        for client in clients:
+            address = client.address
+            label = f"{address[0]}:{address[1]}" if isinstance(address, tuple) else str(address)
+            lines.append(f'skyloong_client_uptime_seconds{{client="{label}"}} {now - client.connected_at:.1f}')
+        return "\n".join(lines) + "\n"
+
+# HTTP endpoint serving /metrics, /power?seconds=N (wakeup diagnostics, measured over N seconds) and
+# /history?seconds=N (JSON statistics) when a MetricsHistory is given
+class MetricsHTTPServer:
+    def __init__(self, metrics, get_clients, history=None, host='127.0.0.1', port=9648):
+        self.metrics = metrics
+        # Returns the ClientRegistry snapshot
+        self.get_clients = get_clients
+        self.history = history
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """Starts serving in a background thread"""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/metrics':
+                    body = exporter.metrics.render(exporter.get_clients()).encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                elif url.path == '/history' and exporter.history is not None:
+                    try:
+                        seconds = float(parse_qs(url.query).get('seconds', ['60'])[0])
+                    except ValueError:
+                        self.send_error(400, "seconds must be a number")
+                        return
+                    body = json.dumps({'seconds': seconds, 'stats': exporter.history.stats(seconds)}).encode('utf-8')
+                    content_type = 'application/json'
+                elif url.path == '/power':
+                    try:
+                        seconds = float(parse_qs(url.query).get('seconds', ['2'])[0])
+                    except ValueError:
+                        self.send_error(400, "seconds must be a number")
+                        return
+                    body = json.dumps(WHEEL.diagnostics(seconds)).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are not worth a log line
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        # A long poll interval keeps the idle wakeups low, stop() wakes the loop with a connection
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': IDLE_INTERVAL})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops serving and closes the socket"""
+        if self.httpd is not None:
+            stopper = threading.Thread(target=self.httpd.shutdown)
+            stopper.start()
+            host = {'': '127.0.0.1', '0.0.0.0': '127.0.0.1', '::': '::1'}.get(self.host, self.host)
+            while stopper.is_alive():
+                try:
+                    socket.create_connection((host, self.port), timeout=0.5).close()
+                except OSError:
+                    pass
+                stopper.join(0.1)
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,197 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from metrics_providers import MetricsProvider
+
+# Layout of the shared segment: a sequence number (odd while the parent writes it), then the CPU %, memory %,
+# sample time and label (UTF-8, zero-padded) of the last snapshot
+SEQUENCE = struct.Struct('<Q')
+VALUES = struct.Struct('<ddd32s')
+SEGMENT_SIZE = SEQUENCE.size + VALUES.size
+# A worker failing this soon after its start is not restarted, it would only fail again
+WORKER_MIN_UPTIME = 5.0
+# Seconds given to a worker to stop after SIGTERM before it is killed
+WORKER_STOP_TIMEOUT = 5.0
+
+# Identity of a worker process given to serve(): its number (0 to N-1) and the name of the shared segment
+WorkerSpec = namedtuple('WorkerSpec', ['index', 'segment'])
+
+# Last snapshot of the sampler, in shared memory
+# The parent process is the only writer and the workers read without any lock (sequence lock: a read that
+# overlapped a write sees an odd or changed sequence number, and is retried).
+class MetricsSegment:
+    def __init__(self, name=None):
+        # The segment is created by the parent (no name) and attached by the workers
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner,
+                                                 size=SEGMENT_SIZE if self.owner else 0)
+        self.sequence = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def publish(self, snapshot):
+        """Writes a snapshot (parent process only, called from the sampling thread)"""
+        buffer = self.memory.buf
+        SEQUENCE.pack_into(buffer, 0, self.sequence + 1)
+        VALUES.pack_into(buffer, SEQUENCE.size, snapshot.cpu, snapshot.mem, snapshot.timestamp,
+                         (snapshot.label or '').encode('utf-8'))
+        self.sequence += 2
+        SEQUENCE.pack_into(buffer, 0, self.sequence)
+
+    def read(self):
+        """Returns the (cpu, mem, timestamp, label) of the last snapshot"""
+        buffer = self.memory.buf
+        while True:
+            sequence = SEQUENCE.unpack_from(buffer)[0]
+            cpu, mem, timestamp, label = VALUES.unpack_from(buffer, SEQUENCE.size)
+            if not sequence % 2 and SEQUENCE.unpack_from(buffer)[0] == sequence:
+                # The label may have been cut in the middle of a character
+                return cpu, mem, timestamp, label.rstrip(b'\0').decode('utf-8', 'ignore') or None
+
+    def close(self):
+        """Detaches the segment, and removes it in the parent"""
+        self.memory.close()
+        if self.owner:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+
+# Value sampled by the parent process, read from the shared segment (worker processes)
+class SharedMetricsProvider(MetricsProvider):
+    name = 'shared'
+
+    def __init__(self, segment, column):
+        self.segment = segment
+        self.column = column
+        self.label = None
+
+    def read(self):
+        values = self.segment.read()
+        self.label = values[3]
+        return values[self.column]
+
+    def close(self):
+        # Both providers share the segment, closing it twice is harmless
+        self.segment.close()
+
+def create_shared_providers(name):
+    """Creates the CPU and memory providers of a worker, reading the segment of the parent"""
+    segment = MetricsSegment(name)
+    return [SharedMetricsProvider(segment, 0), SharedMetricsProvider(segment, 1)]
+
+def run_worker(args, defaults, worker, overrides=None):
+    """Entry point of a worker process: serves the keyboards the kernel gives to its sockets until stopped"""
+    # Stop with the parent even if it was killed, the values would no longer be updated
+    parent = multiprocessing.parent_process()
+
+    def watch_parent():
+        multiprocessing.connection.wait([parent.sentinel])
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=watch_parent, name='parent-watch', daemon=True).start()
+    from keyboard_server import serve
+    sys.exit(serve(args, defaults, worker, overrides))
+
+# Worker processes of the sharded mode, started with 'spawn' (the parent has threads, fork would copy their locks)
+class WorkerPool:
+    def __init__(self, args, defaults, segment, count, overrides=None):
+        self.context = multiprocessing.get_context('spawn')
+        self.args = args
+        self.defaults = defaults
+        self.overrides = overrides
+        self.segment = segment
+        self.count = count
+        # {index: (Process, start time)}
+        self.workers = {}
+        self.log = print
+
+    def start_worker(self, index):
+        """Starts (or restarts) one worker"""
+        process = self.context.Process(target=run_worker, name=f'worker-{index}',
+                                       args=(self.args, self.defaults, WorkerSpec(index, self.segment),
+                                             self.overrides))
+        process.start()
+        self.workers[index] = (process, time.monotonic())
+        self.log(f"Worker {index} started (pid {process.pid})")
+
+    def start(self):
+        """Starts every worker"""
+        for index in range(self.count):
+            self.start_worker(index)
+
+    def wait(self, wakeup_socket):
+        """Sleeps until wakeup_socket is readable (stop requested) or a worker exits, restarting the failed ones
+        Returns False if a worker failed right after its start, or if every worker exited."""
+        while self.workers:
+            sentinels = {process.sentinel: index for index, (process, _) in self.workers.items()}
+            ready = multiprocessing.connection.wait([wakeup_socket, *sentinels])
+            if wakeup_socket in ready:
+                return True
+            for sentinel in ready:
+                index = sentinels[sentinel]
+                process, started_at = self.workers.pop(index)
+                process.join()
+                if process.exitcode == 0:
+                    # Stopped by a signal of its own (e.g. Ctrl+C on the whole process group)
+                    self.log(f"Worker {index} stopped")
+                    continue
+                self.log(f"Worker {index} exited with code {process.exitcode}")
+                if time.monotonic() - started_at < WORKER_MIN_UPTIME:
+                    return False
+                self.start_worker(index)
+        return False
+
+    def stop(self):
+        """Stops every worker (SIGTERM, then SIGKILL if it does not exit in time)"""
+        for process, _ in self.workers.values():
+            process.terminate()
+        for process, _ in self.workers.values():
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.workers.clear()
+
+def serve_workers(args, defaults, sampler, pool=None, overrides=None):
+    """Samples the metrics in this process and serves the keyboards from args.workers processes (Linux)
+    Every worker binds the same addresses with SO_REUSEPORT, the kernel spreads the connections between them,
+    and reads the snapshots from shared memory instead of sampling the system itself."""
+    segment = MetricsSegment()
+    segment.publish(sampler.snapshot)
+    sampler.on_sample = segment.publish
+    sampler.start()
+    if pool is not None:
+        pool.start()
+
+    workers = WorkerPool(args, defaults, segment.name, args.workers, overrides)
+    # The signal handlers only write to the socket pair, which wakes the wait below
+    wakeup_sockets = socket.socketpair()
+    signal.signal(signal.SIGINT, lambda signum, frame: wakeup_sockets[1].send(b'\0'))
+    signal.signal(signal.SIGTERM, lambda signum, frame: wakeup_sockets[1].send(b'\0'))
+    try:
+        workers.start()
+        stopped = workers.wait(wakeup_sockets[0])
+    finally:
+        workers.stop()
+        if pool is not None:
+            pool.stop()
+        sampler.close()
+        segment.close()
+        for sock in wakeup_sockets:
+            sock.close()
+    if not stopped:
+        print("The workers failed, server stopped")
+        return 1
+    return 0
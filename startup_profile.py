@@ -0,0 +1,32 @@
+import time
+
+# Timeline of the startup, printed with --profile-startup
+# The marks are recorded from the first import on (a perf_counter read and a list append each) and are only
+# printed on demand; times are shown from the creation of the process, so the interpreter startup is included.
+class StartupTimeline:
+    def __init__(self):
+        self.marks = [('interpreter ready', time.perf_counter())]
+
+    def mark(self, label):
+        """Records the end of a startup step"""
+        self.marks.append((label, time.perf_counter()))
+
+    def since_process_start(self, perf_time=None):
+        """Returns the milliseconds from the creation of the process to perf_time (default: now)"""
+        import psutil
+        now = time.perf_counter()
+        perf_time = now if perf_time is None else perf_time
+        return (time.time() - psutil.Process().create_time() - (now - perf_time)) * 1000
+
+    def report(self, output=print):
+        """Prints every step with its time from the process start and its duration"""
+        output("Startup timeline (ms from process start, step duration):")
+        previous = None
+        for label, perf_time in self.marks:
+            elapsed = self.since_process_start(perf_time)
+            step = elapsed if previous is None else elapsed - previous
+            output(f"{elapsed:9.1f} {step:+8.1f}  {label}")
+            previous = elapsed
+
+# Timeline of this process
+STARTUP = StartupTimeline()
@@ -0,0 +1,68 @@
+"""Tests of the timer wheel: timers cancelled from a callback, while the wheel is running its due slots.
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from power import TICK, TimerWheel
+
+def wait_for(condition, timeout=2.0):
+    """Polls condition() until it is true or timeout seconds have passed, returns its last value"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(TICK / 5)
+    return condition()
+
+class CancelFromCallbackTest(unittest.TestCase):
+    def test_cancel_timer_of_a_later_due_slot(self):
+        """A callback cancelling the only timer of a later slot due in the same wakeup does not stop the wheel"""
+        wheel = TimerWheel()
+        runs = []
+        timers = {}
+
+        def first():
+            runs.append('first')
+            wheel.cancel(timers['later'])
+
+        # The wheel thread waits for the lock, so both slots are due when it wakes
+        with wheel._condition:
+            timers['first'] = wheel.schedule(first, 0.1, name='first')
+            timers['later'] = later = wheel.schedule(lambda: runs.append('later'), 0.1, name='later')
+            wheel._unplace(later)
+            later.slot = timers['first'].slot + 1
+            wheel.slots[later.slot] = [later]
+            time.sleep(max(0.0, (later.slot + 1) * TICK - time.monotonic()))
+
+        self.assertTrue(wait_for(lambda: 'first' in runs))
+        # The wheel still runs the timers scheduled afterwards
+        after = threading.Event()
+        wheel.schedule(after.set, 0.1, name='after')
+        self.assertTrue(after.wait(2.0))
+        self.assertTrue(wheel.thread.is_alive())
+        self.assertNotIn('later', runs)
+
+    def test_cancel_own_timer(self):
+        """A callback can cancel its own timer, in the wheel thread and in the worker thread"""
+        wheel = TimerWheel()
+        for background in (False, True):
+            runs = []
+            timers = {}
+
+            def callback():
+                runs.append(threading.current_thread().name)
+                wheel.cancel(timers['self'])
+
+            timers['self'] = wheel.schedule(callback, 0.1, background=background)
+            self.assertTrue(wait_for(lambda: runs))
+            time.sleep(0.3)
+            self.assertEqual(runs, ['timer-worker' if background else 'timer-wheel'])
+            self.assertNotIn(timers['self'], wheel.timers)
+
+if __name__ == "__main__":
+    unittest.main()